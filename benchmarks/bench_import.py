@@ -0,0 +1,78 @@
+""" Benchmark the time it takes to import ipp_tools
+
+Each import is timed in a fresh interpreter. Exits with a nonzero status if the median
+import time exceeds the budget or if importing pulled in a heavy dependency.
+
+usage: python benchmarks/bench_import.py [--budget SECONDS] [--repeats N]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+MODULES = ['ipp_tools', 'ipp_tools.engine_pool', 'ipp_tools.gpu', 'ipp_tools.log_tools',
+           'ipp_tools.mappers', 'ipp_tools.pilot', 'ipp_tools.pool', 'ipp_tools.slurm', 'ipp_tools.startup',
+           'ipp_tools.utils']
+
+# dependencies that must only be imported on first use
+HEAVY_MODULES = ['ipyparallel', 'numpy', 'zmq', 'IPython']
+
+TIMING_SCRIPT = """
+import json, sys, time
+start_time = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+import_time = time.perf_counter() - start_time
+print(json.dumps({{'import_time': import_time,
+                  'heavy': [module for module in {heavy!r} if module in sys.modules]}}))
+"""
+
+
+def time_import(repo_path):
+    """ Time importing all of MODULES in a fresh interpreter
+
+    Returns:
+      import_time: seconds taken
+      heavy: heavy modules that ended up imported
+    """
+    script = TIMING_SCRIPT.format(modules=MODULES, heavy=HEAVY_MODULES)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([repo_path, env.get('PYTHONPATH', '')])
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    timing = json.loads(output.decode())
+    return timing['import_time'], timing['heavy']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--budget', type=float, default=0.1,
+                        help='maximum median import time in seconds')
+    parser.add_argument('--repeats', type=int, default=11)
+    args = parser.parse_args()
+
+    repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    import_times = []
+    heavy = set()
+    for _ in range(args.repeats):
+        import_time, heavy_imported = time_import(repo_path)
+        import_times.append(import_time)
+        heavy.update(heavy_imported)
+
+    median_time = sorted(import_times)[len(import_times) // 2]
+    print("import ipp_tools: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms over {} runs".format(
+        1e3 * median_time, 1e3 * min(import_times), 1e3 * max(import_times), args.repeats))
+
+    failed = False
+    if heavy:
+        print("FAIL: importing ipp_tools imported {}".format(', '.join(sorted(heavy))))
+        failed = True
+    if median_time > args.budget:
+        print("FAIL: median import time exceeds budget of {:.1f} ms".format(1e3 * args.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+""" Benchmark serialization of NumPy payloads, in-band pickle vs out-of-band buffers
+
+For payloads of 1 MB up to 1 GB, each serializer round trips a list of a dict holding a float
+array and a mask (i.e. arrays nested in containers, as tasks often return them) and reports
+the bytes copied into and out of the pickle stream and the round trip throughput.
+Transport over ZeroMQ is not included.
+
+Then, for a compressible payload (a smooth float32 field and a sparse mask), each available
+codec is timed and the time to send the payload over a network of the given bandwidth
+is compared with and without compression, along with the bandwidth below which
+compression wins.
+
+usage: python benchmarks/bench_serialization.py [--max-mb 1024] [--repeats 3] [--bandwidth-mbps 1000]
+"""
+
+import argparse
+import importlib.util
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+
+SIZES_MB = [1, 10, 100, 1024]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_payload(n_bytes):
+    """ A list holding a dict of a float64 array and a boolean mask, n_bytes in total
+    """
+    n_values = max(n_bytes // 9, 1)
+    return [{'values': np.random.rand(n_values), 'mask': np.random.rand(n_values) > 0.5}]
+
+
+def make_compressible_payload(n_bytes):
+    """ A smooth float32 field and a sparse mask, n_bytes in total
+    """
+    n_values = max(n_bytes // 5, 1)
+    field = np.cumsum(np.random.randn(n_values).astype(np.float32) * 1e-3).astype(np.float32)
+    return [{'field': np.round(field, 3), 'mask': np.random.rand(n_values) > 0.99}]
+
+
+def roundtrip_pickle(payload):
+    """ Plain pickle, as ipyparallel sends nested arrays
+
+    Returns:
+      bytes_copied: bytes copied into the pickle stream and back out of it
+    """
+    data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.loads(data)
+    return 2 * len(data)
+
+
+def roundtrip_ipyparallel(payload):
+    """ ipyparallel's own serialization
+    """
+    from ipyparallel.serialize import serialize_object, deserialize_object
+    buffers = serialize_object(payload)
+    deserialize_object(buffers)
+    return 2 * sum(len(buf) for buf in buffers if isinstance(buf, bytes))
+
+
+def roundtrip_oob(payload):
+    """ ipyparallel serialization of an OOBPayload
+    """
+    from ipyparallel.serialize import serialize_object, deserialize_object
+    from ipp_tools.serialization import OOBPayload, register_canning
+    register_canning()
+    buffers = serialize_object(OOBPayload(payload))
+    deserialize_object(buffers)
+    return 2 * sum(len(buf) for buf in buffers if isinstance(buf, bytes))
+
+
+def roundtrip_pickle5(payload):
+    """ pickle protocol 5 with out-of-band buffers, without ipyparallel
+    """
+    buffers = []
+    data = pickle.dumps(payload, protocol=5, buffer_callback=buffers.append)
+    pickle.loads(data, buffers=buffers)
+    return 2 * len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--max-mb', type=int, default=1024)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--bandwidth-mbps', type=float, default=1000.,
+                        help='network bandwidth in Mbit/s to estimate transfer times for')
+    args = parser.parse_args()
+
+    serializers = [('pickle', roundtrip_pickle), ('pickle5-oob', roundtrip_pickle5)]
+    if importlib.util.find_spec('ipyparallel') is not None:
+        serializers += [('ipyparallel', roundtrip_ipyparallel), ('ipyparallel-oob', roundtrip_oob)]
+    else:
+        print("ipyparallel not installed, only benchmarking plain pickle")
+
+    print("{:>10} {:>16} {:>14} {:>12}".format('size (MB)', 'serializer', 'copied (MB)', 'MB/s'))
+    for size_mb in [size_mb for size_mb in SIZES_MB if size_mb <= args.max_mb]:
+        payload = make_payload(size_mb * 2 ** 20)
+        payload_mb = sum(arr.nbytes for arr in payload[0].values()) / 2. ** 20
+        for name, roundtrip in serializers:
+            elapsed = []
+            for _ in range(args.repeats):
+                start_time = time.perf_counter()
+                bytes_copied = roundtrip(payload)
+                elapsed.append(time.perf_counter() - start_time)
+            print("{:>10} {:>16} {:>14.2f} {:>12.0f}".format(
+                size_mb, name, bytes_copied / 2. ** 20, payload_mb / min(elapsed)))
+
+    print("")
+    bench_compression(args)
+
+
+def bench_compression(args):
+    """ Compare sending compressible payloads raw and compressed with each available codec
+    """
+    from ipp_tools.serialization import CODECS, compress, decompress
+
+    bandwidth = args.bandwidth_mbps * 1e6 / 8
+    print("Compression at {:.0f} Mbit/s".format(args.bandwidth_mbps))
+    print("{:>10} {:>7} {:>7} {:>10} {:>10} {:>10} {:>6} {:>15}".format(
+        'size (MB)', 'codec', 'ratio', 'comp (s)', 'decomp (s)', 'send (s)', 'wins', 'break-even Mb/s'))
+    for size_mb in [size_mb for size_mb in SIZES_MB if size_mb <= args.max_mb]:
+        payload = make_compressible_payload(size_mb * 2 ** 20)
+        buffers = [memoryview(arr).cast('B') for arr in payload[0].values()]
+        n_bytes = sum(buf.nbytes for buf in buffers)
+        raw_time = n_bytes / bandwidth
+        print("{:>10} {:>7} {:>7.2f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            size_mb, 'none', 1., 0., 0., raw_time))
+        for codec in CODECS:
+            try:
+                compress_time = decompress_time = float('inf')
+                for _ in range(args.repeats):
+                    start_time = time.perf_counter()
+                    compressed = [compress(buf, codec, arr.itemsize)
+                                  for buf, arr in zip(buffers, payload[0].values())]
+                    compress_time = min(compress_time, time.perf_counter() - start_time)
+                    start_time = time.perf_counter()
+                    for buf in compressed:
+                        decompress(buf, codec)
+                    decompress_time = min(decompress_time, time.perf_counter() - start_time)
+            except ImportError:
+                continue
+            n_compressed = sum(len(buf) for buf in compressed)
+            send_time = compress_time + n_compressed / bandwidth + decompress_time
+            break_even = 8e-6 * (n_bytes - n_compressed) / (compress_time + decompress_time)
+            print("{:>10} {:>7} {:>7.2f} {:>10.3f} {:>10.3f} {:>10.3f} {:>6} {:>15.0f}".format(
+                size_mb, codec, n_bytes / float(n_compressed), compress_time, decompress_time,
+                send_time, 'yes' if send_time < raw_time else 'no', break_even))
+
+
+if __name__ == '__main__':
+    main()
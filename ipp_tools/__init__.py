@@ -0,0 +1,13 @@
+""" IPyParallel utilities
+
+Submodules are kept light at import time: ipyparallel and numpy are only imported
+when a function that needs them is called.
+"""
+
+
+def __getattr__(name):
+    # re-exported lazily, so importing ipp_tools doesn't import its submodules
+    if name == 'local_map':
+        from ipp_tools.engine_pool import local_map
+        return local_map
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
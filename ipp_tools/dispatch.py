@@ -0,0 +1,822 @@
+""" This module contains the task dispatch loop used by slurm_map
+"""
+
+import functools
+import itertools
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+import types
+
+from warnings import warn
+
+from six.moves.queue import Queue, Empty
+
+from ipp_tools.utils import rss_mb
+
+# names fnc and setup are pushed under in each engine's namespace
+FNC_NAME = '_ipp_tools_fnc'
+SETUP_NAME = '_ipp_tools_setup'
+
+# stragglers are only detected once this many tasks have finished, to estimate the median
+MIN_FINISHED_FOR_SPECULATION = 5
+
+# seconds past task_timeout after which an engine that didn't interrupt its task is shut down
+TIMEOUT_GRACE_SECONDS = 30
+
+# errors of tasks lost with their engine, rather than failed
+LOST_TASK_ERRORS = ('EngineError', 'ImpossibleDependency')
+
+# recycled engines exit with this status, on which the engine launch scripts start a fresh engine
+RECYCLE_EXIT_CODE = 75
+
+# resource limiting the memory of tasks. On Linux the data segment limit covers heap and anonymous
+# mappings but not the address space that libraries and thread stacks reserve without using
+MEMORY_RLIMIT = resource.RLIMIT_DATA if sys.platform.startswith('linux') else resource.RLIMIT_AS
+# line of /proc/self/status with the current size of MEMORY_RLIMIT's resource
+MEMORY_RLIMIT_STATUS = 'VmData:' if sys.platform.startswith('linux') else 'VmSize:'
+
+
+class TaskTimeout(Exception):
+    """ Raised in a task that ran for longer than its timeout
+    """
+
+
+def windowed_map(client, fnc, iterable, max_in_flight=None, setup=None, use_cloudpickle=False,
+                 speculative_factor=None, speculative_budget=0.01, task_timeout=None, timeout_retries=1,
+                 retry_policy=None, engine_lost_callback=None, engine_ready_callback=None,
+                 max_tasks_per_engine=None, max_engine_rss_mb=None, task_memory_mb=None, status_interval=5.,
+                 purge_interval=1000, engine_poll_interval=1., engine_wait_timeout=600.):
+    """ Map fnc over iterable on the engines of client, keeping a bounded number of tasks in flight
+
+    iterable is consumed lazily: a new task is only submitted when one in flight finishes,
+    so neither the client nor the controller ever holds more than max_in_flight tasks,
+    however large (or infinite) iterable is.
+
+    Every engine is set up once, as soon as it registers (including engines that join while
+    tasks are running): fnc and setup are pushed into the engine's namespace, then setup is
+    called. Tasks refer to fnc by name, so task messages only carry arguments.
+    Globals that setup assigns are visible to fnc if both are defined in the same module.
+
+    Stragglers can be executed speculatively: once every task has been submitted and none is
+    waiting for an engine, a task that has been running speculative_factor times longer than
+    the median task is duplicated on an idle engine. The first result wins; the other copy is
+    aborted if it hasn't started yet, otherwise its engine is interrupted with SIGINT. Only
+    enable this if fnc can safely run twice on the same argument, and can be interrupted.
+
+    Tasks running longer than task_timeout are interrupted by an alarm signal on their engine.
+    An engine stuck outside of Python (e.g. in a deadlocked I/O call) that doesn't interrupt
+    its task within TIMEOUT_GRACE_SECONDS is shut down. Timed out tasks are retried on other
+    engines up to timeout_retries times, then recorded as failed: their result is the error
+    and the remaining tasks carry on.
+
+    Failed tasks are retried according to retry_policy, see process_retry_policy: tasks lost
+    with their engine (e.g. a preempted node) and tasks that raised one of the retryable errors
+    are resubmitted to other engines, after an optional backoff, until they run out of attempts.
+    Then they are recorded as failed like timed out tasks. Any other error in a task is raised.
+
+    Engines that leak memory can be recycled: once an engine has run max_tasks_per_engine tasks,
+    or its resident memory after a task exceeds max_engine_rss_mb, it gets no new tasks and exits
+    with RECYCLE_EXIT_CODE as soon as its queued tasks are done, so no work is lost.
+    The scripts that launch engines start a fresh engine in its place, which is set up as usual.
+
+    Tasks can run under a soft memory limit, set just around each task, that lets them allocate
+    task_memory_mb on top of what their engine has mapped when they start. Allocations beyond it
+    raise MemoryError in the task instead of getting the engine killed by the scheduler, the task
+    is recorded as failed and the engine carries on.
+
+    Args:
+      client: ipyparallel Client connected to the cluster
+      fnc: function to apply to each element of iterable
+      iterable: arguments of fnc, one task per element
+      max_in_flight: (optional) maximum number of tasks submitted but not finished.
+        Defaults to twice the number of set up engines, re-evaluated as engines join
+      setup: (optional) callable run once on each engine before it gets any tasks,
+        e.g. to import heavy libraries or load a model into globals
+      use_cloudpickle: (optional) if True, engines serialize with cloudpickle
+      speculative_factor: (optional) duplicate tasks running this many times longer than
+        the median task. None disables speculative execution
+      speculative_budget: (optional) fraction of the tasks that may be duplicated, at least one
+      task_timeout: (optional) seconds a task may run for. None disables timeouts
+      timeout_retries: (optional) number of times a timed out task is retried
+      retry_policy: (optional) dict of retry settings, see process_retry_policy
+      engine_lost_callback: (optional) called with the id of each engine that is lost
+        while tasks are running, e.g. to request a replacement
+      engine_ready_callback: (optional) called with the id of each engine once it's set up
+      max_tasks_per_engine: (optional) recycle engines after this many tasks
+      max_engine_rss_mb: (optional) recycle engines whose resident memory exceeds this
+      task_memory_mb: (optional) memory a task may allocate on top of what its engine has mapped.
+        None disables the limit
+      status_interval: (optional) seconds between checks of which tasks are running where,
+        to detect stragglers and stuck engines
+      purge_interval: (optional) finished tasks are purged from the controller's database
+        in batches of this many
+      engine_poll_interval: (optional) seconds between checks for newly registered engines
+      engine_wait_timeout: (optional) seconds to wait for an engine while there are none,
+        e.g. after every engine was lost, before raising TimeoutError
+
+    Returns:
+      results: list of the results of fnc, in the order of iterable
+    """
+    dispatcher = _WindowedMap(client, fnc, iterable, max_in_flight=max_in_flight, setup=setup,
+                              use_cloudpickle=use_cloudpickle, speculative_factor=speculative_factor,
+                              speculative_budget=speculative_budget, task_timeout=task_timeout,
+                              timeout_retries=timeout_retries, retry_policy=retry_policy,
+                              engine_lost_callback=engine_lost_callback,
+                              engine_ready_callback=engine_ready_callback,
+                              max_tasks_per_engine=max_tasks_per_engine, max_engine_rss_mb=max_engine_rss_mb,
+                              task_memory_mb=task_memory_mb, status_interval=status_interval,
+                              purge_interval=purge_interval, engine_poll_interval=engine_poll_interval,
+                              engine_wait_timeout=engine_wait_timeout)
+    return dispatcher.run()
+
+
+class _WindowedMap(object):
+    """ State of one windowed_map call, see windowed_map for the arguments
+    """
+
+    def __init__(self, client, fnc, iterable, max_in_flight=None, setup=None, use_cloudpickle=False,
+                 speculative_factor=None, speculative_budget=0.01, task_timeout=None, timeout_retries=1,
+                 retry_policy=None, engine_lost_callback=None, engine_ready_callback=None,
+                 max_tasks_per_engine=None, max_engine_rss_mb=None, task_memory_mb=None, status_interval=5.,
+                 purge_interval=1000, engine_poll_interval=1., engine_wait_timeout=600.):
+        self.client = client
+        if task_memory_mb is not None:
+            fnc = with_memory_limit(fnc, task_memory_mb)
+        if task_timeout is not None:
+            fnc = with_timeout(fnc, task_timeout)
+        if max_engine_rss_mb is not None:
+            # results come back as (result, resident memory of the engine)
+            fnc = functools.partial(_run_and_measure_rss, fnc)
+        self.fnc = fnc
+        self.setup = setup
+        self.use_cloudpickle = use_cloudpickle
+        self.max_in_flight = max_in_flight
+        self.speculative_factor = speculative_factor
+        self.speculative_budget = speculative_budget
+        self.task_timeout = task_timeout
+        self.timeout_retries = timeout_retries
+        self.retry_policy = process_retry_policy(retry_policy or {})
+        self.engine_lost_callback = engine_lost_callback
+        self.engine_ready_callback = engine_ready_callback
+        self.max_tasks_per_engine = max_tasks_per_engine
+        self.max_engine_rss_mb = max_engine_rss_mb
+        self.task_memory_mb = task_memory_mb
+        self.status_interval = status_interval
+        self.purge_interval = purge_interval
+        self.engine_poll_interval = engine_poll_interval
+        self.engine_wait_timeout = engine_wait_timeout
+
+        self.args = enumerate(iterable)
+        self.exhausted = False
+        self.n_submitted = 0
+
+        # engines that are set up, or are being set up (engine id -> pending AsyncResults)
+        self.ready_engines = []
+        self.engines_in_setup = {}
+        # engines shut down by the dispatcher, never given tasks again. A new engine may request
+        # the id of one that unregistered, so ids are only retired until they unregister
+        self.retired_engines = set()
+        self.n_retired = 0
+        # retired engines shut down for being stuck, lost (and replaced) once they unregister
+        self.stuck_engines = set()
+        # engines to recycle once their queued tasks are done
+        self.draining_engines = set()
+        self.engine_task_counts = {}
+        self.n_recycled = 0
+        self.last_drain_check = 0.
+        self.view = None
+
+        # task idx -> {'arg', 'msg_ids' of the attempts in flight, 'n_timeouts', 'n_failures'}
+        self.tasks = {}
+        # (time to resubmit, task idx, engine id to avoid) of failed tasks waiting to be retried
+        self.retries = []
+        # msg id of an attempt in flight -> task idx
+        self.attempts = {}
+        # msg id of a running attempt -> (engine id, time it was first seen running)
+        self.running = {}
+        # msg id of an attempt lost to an engine shut down for not interrupting it -> engine id
+        self.stuck = {}
+        # engines sent SIGINT to interrupt a losing copy, which may hit the engine's next task instead
+        self.interrupted_engines = set()
+        self.finished = Queue()
+        self.results = {}
+        self.failed = []
+        self.run_times = []
+
+        self.n_speculated = 0
+        self.last_status = time.time()
+        # last time an engine was ready or being set up
+        self.last_engine_time = time.time()
+
+        # the controller records a result slightly after the client receives it, so finished tasks
+        # are purged from the controller one batch behind
+        self.to_purge = []
+        self.purge_next = []
+
+    def run(self):
+        """ Runs every task, returns the results in the order of the arguments
+        """
+        start_time = time.time()
+        while True:
+            self._setup_new_engines()
+            self._recycle_drained_engines()
+            self._submit_retries()
+            self._fill_window()
+
+            if self.exhausted and not self.tasks:
+                break
+
+            if self.ready_engines or self.engines_in_setup:
+                self.last_engine_time = time.time()
+            elif time.time() - self.last_engine_time > self.engine_wait_timeout:
+                raise TimeoutError("No engine for {:.0f} seconds, {} tasks finished".format(
+                    time.time() - self.last_engine_time, len(self.results)))
+
+            if time.time() - self.last_status > self.status_interval:
+                self.last_status = time.time()
+                no_unassigned = self._update_running()
+                if self.task_timeout is not None:
+                    self._stop_stuck_engines()
+                if self.speculative_factor is not None and self.exhausted and no_unassigned:
+                    self._speculate()
+
+            try:
+                async_result = self.finished.get(timeout=self.engine_poll_interval)
+            except Empty:
+                continue
+            if not self._handle_finished(async_result):
+                continue
+
+            n_finished = len(self.results)
+            if n_finished % 1000 == 0:
+                print("{} tasks finished after {:.0f} seconds, {} in flight".format(
+                    n_finished, time.time() - start_time, len(self.tasks)))
+
+        if self.to_purge or self.purge_next:
+            _purge_hub_results(self.client, self.to_purge + self.purge_next)
+        if self.n_speculated:
+            print("Speculatively re-executed {} straggler tasks".format(self.n_speculated))
+        if self.n_recycled:
+            print("Recycled {} engines".format(self.n_recycled))
+        if self.failed:
+            warn("{} tasks failed, their results are their errors. First failed tasks: {}".format(
+                len(self.failed), sorted(self.failed)[:10]))
+
+        return [self.results[task_idx] for task_idx in range(len(self.results))]
+
+    def _setup_new_engines(self):
+        """ Start setting up newly registered engines and move finished ones to ready_engines
+
+        Setup messages are sent without blocking, so engines are set up in parallel
+        """
+        from ipyparallel import Reference
+
+        ready_before = list(self.ready_engines)
+        registered_engines = set(self.client.ids)
+        for engine_id in list(self.ready_engines) + list(self.engines_in_setup) + list(self.stuck_engines):
+            if engine_id not in registered_engines:
+                self._lose_engine(engine_id)
+        self.retired_engines &= registered_engines
+
+        for engine_id in self.client.ids:
+            if (engine_id in self.ready_engines or engine_id in self.engines_in_setup
+                    or engine_id in self.draining_engines or engine_id in self.retired_engines):
+                continue
+            engine = self.client[engine_id]
+            pending = []
+            if self.use_cloudpickle:
+                pending.append(engine.use_cloudpickle())
+            pending.append(engine.push({FNC_NAME: self.fnc, SETUP_NAME: self.setup}, block=False))
+            if self.setup is not None:
+                pending.append(engine.apply_async(_run_setup, Reference(FNC_NAME), Reference(SETUP_NAME)))
+            self.engines_in_setup[engine_id] = pending
+
+        for engine_id, pending in list(self.engines_in_setup.items()):
+            if all(async_result.ready() for async_result in pending):
+                del self.engines_in_setup[engine_id]
+                for async_result in pending:
+                    # raises if setup failed
+                    async_result.get()
+                self.ready_engines.append(engine_id)
+                self.engine_task_counts[engine_id] = 0
+                print("Engine {} set up, {} engines ready".format(engine_id, len(self.ready_engines)))
+                if self.engine_ready_callback is not None:
+                    self.engine_ready_callback(engine_id)
+
+        if self.ready_engines != ready_before and self.ready_engines:
+            self.view = self.client.load_balanced_view(targets=list(self.ready_engines))
+
+    def _count_engine_task(self, engine_id, rss_mb):
+        """ Count a task finished by an engine, and start draining it if it's due for recycling
+        """
+        if engine_id not in self.ready_engines:
+            return
+        n_tasks = self.engine_task_counts.get(engine_id, 0) + 1
+        self.engine_task_counts[engine_id] = n_tasks
+        if ((self.max_tasks_per_engine is not None and n_tasks >= self.max_tasks_per_engine)
+                or (rss_mb is not None and rss_mb > self.max_engine_rss_mb)):
+            print("Recycling engine {} after {} tasks{}".format(
+                engine_id, n_tasks, '' if rss_mb is None else ', {:.0f} MB resident'.format(rss_mb)))
+            self.ready_engines.remove(engine_id)
+            if self.ready_engines:
+                self.view = self.client.load_balanced_view(targets=list(self.ready_engines))
+            self.draining_engines.add(engine_id)
+
+    def _recycle_drained_engines(self):
+        """ Make draining engines that have no more tasks exit with RECYCLE_EXIT_CODE
+        """
+        if not self.draining_engines or time.time() - self.last_drain_check < self.engine_poll_interval:
+            return
+        self.last_drain_check = time.time()
+        registered_engines = set(self.client.ids)
+        self.draining_engines &= registered_engines
+        if not self.draining_engines:
+            return
+        try:
+            queue_status = self.client.queue_status(targets=list(self.draining_engines), verbose=True)
+        except IndexError:
+            # an engine unregistered since the last check
+            return
+        for engine_id in list(self.draining_engines):
+            engine_status = queue_status.get(engine_id, {})
+            if engine_status.get('tasks') or engine_status.get('queue'):
+                continue
+            self.draining_engines.remove(engine_id)
+            self.retired_engines.add(engine_id)
+            self.n_retired += 1
+            self.client[engine_id].apply_async(_exit_engine, RECYCLE_EXIT_CODE)
+            self.n_recycled += 1
+
+    def _lose_engine(self, engine_id):
+        """ Forget an engine that unregistered, the controller fails the tasks it was running
+        """
+        self.engines_in_setup.pop(engine_id, None)
+        if engine_id in self.ready_engines:
+            self.ready_engines.remove(engine_id)
+        if engine_id in self.stuck_engines:
+            self.stuck_engines.remove(engine_id)
+        elif engine_id in self.retired_engines:
+            return
+        print("Lost engine {}, {} engines ready".format(engine_id, len(self.ready_engines)))
+        if self.engine_lost_callback is not None and not (self.exhausted and not self.tasks):
+            self.engine_lost_callback(engine_id)
+
+    def _retire_engine(self, engine_id):
+        """ Stop giving tasks to an engine and shut it down
+        """
+        self.retired_engines.add(engine_id)
+        self.n_retired += 1
+        if engine_id in self.ready_engines:
+            self.ready_engines.remove(engine_id)
+            if self.ready_engines:
+                self.view = self.client.load_balanced_view(targets=list(self.ready_engines))
+        try:
+            self.client.shutdown(targets=[engine_id], block=False)
+        except Exception as shutdown_err:
+            print("Failed to shut down engine {}: {}".format(engine_id, shutdown_err))
+
+    def _fill_window(self):
+        """ Submit tasks until the window is full or the arguments are exhausted
+        """
+        if not self.ready_engines:
+            return
+        window = self.max_in_flight or 2 * len(self.ready_engines)
+        while not self.exhausted and len(self.tasks) < window:
+            try:
+                task_idx, arg = next(self.args)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.tasks[task_idx] = {'arg': arg, 'msg_ids': [], 'n_timeouts': 0, 'n_failures': 0}
+            self._submit(task_idx, self.view)
+            self.n_submitted += 1
+
+    def _submit(self, task_idx, view):
+        """ Submit an attempt at task task_idx to view
+        """
+        from ipyparallel import Reference
+
+        async_result = view.apply_async(Reference(FNC_NAME), self.tasks[task_idx]['arg'])
+        msg_id = async_result.msg_ids[0]
+        self.tasks[task_idx]['msg_ids'].append(msg_id)
+        self.attempts[msg_id] = task_idx
+        # called from the client's IO thread, so only hand off to the dispatch loop here
+        async_result.add_done_callback(self.finished.put)
+
+    def _handle_finished(self, async_result):
+        """ Record the result of a finished attempt
+
+        Returns:
+          task_finished: True if this attempt finished its task
+        """
+        task_finished = False
+        msg_id = async_result.msg_ids[0]
+        task_idx = self.attempts.pop(msg_id, None)
+        engine_id = self.running.pop(msg_id, (async_result.metadata.get('engine_id'), None))[0]
+        stuck = msg_id in self.stuck
+        engine_id = self.stuck.pop(msg_id, engine_id)
+        if engine_id is None:
+            # lost with its engine, only the engine's uuid is known
+            engine_id = async_result.metadata.get('engine_uuid')
+        # None if the task was already finished by another attempt
+        if task_idx is not None:
+            task = self.tasks[task_idx]
+            task['msg_ids'].remove(msg_id)
+            error_name = None if async_result.successful() else _error_name(async_result)
+            if error_name is None:
+                if self.max_engine_rss_mb is not None:
+                    self.results[task_idx], rss_mb = async_result.get()
+                else:
+                    self.results[task_idx], rss_mb = async_result.get(), None
+                self.run_times.append(_run_time(async_result))
+                self._count_engine_task(engine_id, rss_mb)
+                task_finished = True
+            elif task['msg_ids']:
+                # an error only counts once no other attempt can still succeed
+                pass
+            elif error_name == KeyboardInterrupt.__name__ and engine_id in self.interrupted_engines:
+                # the losing copy the interrupt was meant for finished before it arrived
+                self.interrupted_engines.remove(engine_id)
+                self._submit(task_idx, self.view)
+            elif stuck or error_name == TaskTimeout.__name__:
+                task['n_timeouts'] += 1
+                if task['n_timeouts'] <= self.timeout_retries:
+                    print("Task {} timed out on engine {}, retrying it elsewhere".format(task_idx, engine_id))
+                    self._submit(task_idx, self._view_without(engine_id))
+                else:
+                    print("Task {} timed out {} times, giving up on it".format(task_idx, task['n_timeouts']))
+                    self._fail(task_idx, async_result)
+                    task_finished = True
+            elif self.task_memory_mb is not None and error_name == MemoryError.__name__:
+                # every engine has the same limit, retrying wouldn't help
+                print("Task {} ran out of memory on engine {}".format(task_idx, engine_id))
+                self._fail(task_idx, async_result)
+                task_finished = True
+            elif self._retryable(error_name):
+                task['n_failures'] += 1
+                if task['n_failures'] < self.retry_policy['max_attempts']:
+                    backoff = self.retry_policy['backoff_seconds'] * self.retry_policy['backoff_factor'] ** (task['n_failures'] - 1)
+                    print("Task {} failed with {} on engine {}, retrying it in {:.0f} seconds".format(
+                        task_idx, error_name, engine_id, backoff))
+                    self.retries.append((time.time() + backoff, task_idx, engine_id))
+                else:
+                    print("Task {} failed {} times, giving up on it".format(task_idx, task['n_failures']))
+                    self._fail(task_idx, async_result)
+                    task_finished = True
+            elif self.n_retired and error_name in LOST_TASK_ERRORS:
+                # queued on an engine the dispatcher shut down
+                self._submit(task_idx, self.view)
+            else:
+                # raises the task's error
+                async_result.get()
+
+            if task_finished:
+                del self.tasks[task_idx]
+                self._abort_attempts(task['msg_ids'])
+        elif not async_result.successful() and _error_name(async_result) == KeyboardInterrupt.__name__:
+            # an interrupted losing copy
+            self.interrupted_engines.discard(engine_id)
+
+        self._purge(async_result)
+        return task_finished
+
+    def _fail(self, task_idx, async_result):
+        """ Record a task as failed, its result is the error of its last attempt
+        """
+        self.results[task_idx] = async_result.exception()
+        self.failed.append(task_idx)
+
+    def _retryable(self, error_name):
+        """ Checks if the retry policy retries a task that failed with error_name
+        """
+        if error_name in LOST_TASK_ERRORS:
+            return self.retry_policy['retry_lost']
+        return error_name in self.retry_policy['retry_on']
+
+    def _submit_retries(self):
+        """ Resubmit failed tasks whose backoff is over
+        """
+        if not self.retries or not self.ready_engines:
+            return
+        now = time.time()
+        waiting = []
+        for retry_time, task_idx, engine_id in self.retries:
+            if retry_time <= now:
+                self._submit(task_idx, self._view_without(engine_id))
+            else:
+                waiting.append((retry_time, task_idx, engine_id))
+        self.retries = waiting
+
+    def _view_without(self, engine_id):
+        """ Returns a load balanced view of the ready engines except engine_id, if there are others
+        """
+        targets = [other_id for other_id in self.ready_engines if other_id != engine_id]
+        if not targets:
+            return self.view
+        return self.client.load_balanced_view(targets=targets)
+
+    def _abort_attempts(self, msg_ids):
+        """ Abort the attempts still in flight of a finished task, their results are ignored
+
+        Attempts that haven't started yet are aborted, the engines running the others are interrupted
+        """
+        if not msg_ids:
+            return
+        for msg_id in msg_ids:
+            del self.attempts[msg_id]
+        try:
+            self.client.abort(msg_ids, block=False)
+            queue_status = self.client.queue_status(targets=list(self.ready_engines), verbose=True)
+            running_engines = [engine_id for engine_id in self.ready_engines
+                               if set(msg_ids) & set(queue_status.get(engine_id, {}).get('tasks', []))]
+            if running_engines:
+                self.client.send_signal(signal.SIGINT, targets=running_engines, block=False)
+                self.interrupted_engines.update(running_engines)
+        except Exception as abort_err:
+            print("Failed to abort duplicate tasks {}: {}".format(msg_ids, abort_err))
+
+    def _purge(self, async_result):
+        """ Drop the client's and, in batches, the controller's copy of a finished result
+        """
+        self.client.purge_local_results(async_result)
+        self.purge_next.extend(async_result.msg_ids)
+        if len(self.purge_next) >= self.purge_interval:
+            if self.to_purge:
+                _purge_hub_results(self.client, self.to_purge)
+            self.to_purge, self.purge_next = self.purge_next, []
+
+    def _update_running(self):
+        """ Record which attempts are running on which engine, from the controller's queues
+
+        Start times are accurate to status_interval, which is plenty to spot tasks that
+        run for much longer than they should.
+
+        Returns:
+          no_unassigned: True if no task is waiting for an engine
+        """
+        if not self.ready_engines:
+            return False
+        now = time.time()
+        try:
+            queue_status = self.client.queue_status(targets=list(self.ready_engines), verbose=True)
+        except IndexError:
+            # an engine unregistered since the last check, _setup_new_engines will drop it
+            return False
+        running = {}
+        for engine_id in self.ready_engines:
+            for msg_id in queue_status.get(engine_id, {}).get('tasks', []):
+                if msg_id in self.attempts:
+                    running[msg_id] = (engine_id, self.running.get(msg_id, (None, now))[1])
+        self.running = running
+        return not queue_status.get('unassigned')
+
+    def _stop_stuck_engines(self):
+        """ Shut down engines that didn't interrupt a task TIMEOUT_GRACE_SECONDS after it timed out
+        """
+        now = time.time()
+        for msg_id, (engine_id, running_since) in list(self.running.items()):
+            if engine_id in self.retired_engines:
+                continue
+            # running_since may be late by up to status_interval
+            if now - running_since > self.task_timeout + TIMEOUT_GRACE_SECONDS:
+                print("Engine {} is stuck in task {}, shutting it down".format(engine_id, self.attempts[msg_id]))
+                # the controller fails the engine's tasks once it's gone
+                self.stuck.update((other_msg_id, engine_id) for other_msg_id, (other_engine_id, _)
+                                  in self.running.items() if other_engine_id == engine_id)
+                self._retire_engine(engine_id)
+                self.stuck_engines.add(engine_id)
+
+    def _speculate(self):
+        """ Duplicate stragglers on idle engines, once no task is waiting for an engine
+        """
+        budget = max(1, int(self.speculative_budget * self.n_submitted))
+        if self.n_speculated >= budget or len(self.run_times) < MIN_FINISHED_FOR_SPECULATION:
+            return
+
+        busy_engines = set(engine_id for engine_id, _ in self.running.values())
+        idle_engines = [engine_id for engine_id in self.ready_engines if engine_id not in busy_engines]
+        now = time.time()
+        median_run_time = sorted(self.run_times)[len(self.run_times) // 2]
+        stragglers = sorted((running_since, self.attempts[msg_id])
+                            for msg_id, (_, running_since) in self.running.items()
+                            if len(self.tasks[self.attempts[msg_id]]['msg_ids']) == 1)
+        for running_since, task_idx in stragglers:
+            if not idle_engines or self.n_speculated >= budget:
+                break
+            running_for = now - running_since
+            if running_for <= self.speculative_factor * median_run_time:
+                break
+            engine_id = idle_engines.pop()
+            print("Task {} has been running for {:.0f} seconds, median is {:.1f}. Duplicating it on engine {}".format(
+                task_idx, running_for, median_run_time, engine_id))
+            self._submit(task_idx, self.client.load_balanced_view(targets=[engine_id]))
+            self.n_speculated += 1
+
+
+def process_retry_policy(retry_policy):
+    """ Process retry policy, filling in missing fields with default values
+
+    Fields:
+      max_attempts: number of times a task is attempted before it's recorded as failed
+      backoff_seconds: seconds to wait before the first retry of a task
+      backoff_factor: the wait is multiplied by this for every further retry
+      retry_on: names (or classes) of errors raised by tasks that are worth retrying,
+        e.g. ('OSError', 'ConnectionError'). Errors are matched by their exact name, as engines
+        only report that: subclasses must be listed too, e.g. 'FileNotFoundError' for OSError
+      retry_lost: if True, retry tasks lost with their engine
+    """
+    default_policy = {
+        'max_attempts': 3,
+        'backoff_seconds': 0.,
+        'backoff_factor': 2.,
+        'retry_on': (),
+        'retry_lost': True,
+    }
+    assert set(retry_policy.keys()) <= set(default_policy.keys())
+    default_policy.update(retry_policy)
+    default_policy['retry_on'] = tuple(getattr(error, '__name__', error) for error in default_policy['retry_on'])
+    return default_policy
+
+
+def chunk_tasks(fnc, iterable, chunksize):
+    """ Group tasks into chunks that run as one task each, to amortize per-task overhead
+
+    Args:
+      fnc: function to apply to each element of iterable
+      iterable: arguments of fnc, consumed lazily
+      chunksize: number of arguments per chunk
+
+    Returns:
+      chunk_fnc: function to apply to each chunk, returns the list of results of fnc
+      chunks: iterator over lists of at most chunksize arguments
+      chunk_lengths: list of the length of each chunk, filled in as chunks are consumed
+    """
+    args = iter(iterable)
+    chunk_lengths = []
+
+    def chunks():
+        while True:
+            chunk = list(itertools.islice(args, chunksize))
+            if not chunk:
+                return
+            chunk_lengths.append(len(chunk))
+            yield chunk
+
+    return functools.partial(_run_chunk, fnc), chunks(), chunk_lengths
+
+
+def unchunk_results(chunk_results, chunk_lengths):
+    """ Invert chunk_tasks on the results of chunk_fnc
+
+    A failed chunk's result is its error, which becomes the result of every task in the chunk
+    """
+    results = []
+    for chunk_result, chunk_length in zip(chunk_results, chunk_lengths):
+        if isinstance(chunk_result, Exception):
+            results.extend([chunk_result] * chunk_length)
+        else:
+            results.extend(chunk_result)
+    return results
+
+
+def _run_chunk(fnc, chunk):
+    """ Runs on an engine, applies fnc to each argument in chunk
+    """
+    return [fnc(arg) for arg in chunk]
+
+
+def with_timeout(fnc, timeout):
+    """ Wrap fnc so that it raises TaskTimeout if it runs for longer than timeout seconds
+    """
+    return functools.partial(_run_with_timeout, fnc, timeout)
+
+
+def _run_with_timeout(fnc, timeout, *args, **kwargs):
+    """ Runs on an engine, raises TaskTimeout in fnc if it runs for longer than timeout seconds
+
+    Uses SIGALRM, which only interrupts Python code running in the main thread
+    """
+    if threading.current_thread() is not threading.main_thread():
+        # signals can't be handled here, rely on the client shutting down stuck engines
+        return fnc(*args, **kwargs)
+
+    def handle_alarm(signum, frame):
+        raise TaskTimeout("Task ran for longer than {} seconds".format(timeout))
+
+    previous_handler = signal.signal(signal.SIGALRM, handle_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return fnc(*args, **kwargs)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def with_memory_limit(fnc, limit_mb):
+    """ Wrap fnc so that it raises MemoryError if it allocates more than limit_mb MB
+    """
+    return functools.partial(_run_with_memory_limit, fnc, limit_mb)
+
+
+def _run_with_memory_limit(fnc, limit_mb, *args, **kwargs):
+    """ Runs on an engine, lowers the soft memory limit of the engine while fnc runs
+
+    The limit is limit_mb above what the engine has mapped when fnc starts, so memory held by the
+    engine (libraries loaded by setup, thread stacks, allocator reservations) doesn't count against
+    the task. The limit is lifted again before the result is sent, so an engine that hit it stays
+    usable. Runs fnc without a limit where the mapped memory can't be read
+    """
+    mapped_mb = _mapped_mb()
+    if mapped_mb is None:
+        return fnc(*args, **kwargs)
+    soft_limit, hard_limit = resource.getrlimit(MEMORY_RLIMIT)
+    limit = int((mapped_mb + limit_mb) * 2 ** 20)
+    if hard_limit != resource.RLIM_INFINITY:
+        limit = min(limit, hard_limit)
+    resource.setrlimit(MEMORY_RLIMIT, (limit, hard_limit))
+    try:
+        try:
+            return fnc(*args, **kwargs)
+        finally:
+            resource.setrlimit(MEMORY_RLIMIT, (soft_limit, hard_limit))
+    except MemoryError:
+        raise MemoryError("Task exceeded its memory limit of {:.0f} MB".format(limit_mb))
+
+
+def _mapped_mb():
+    """ Returns the memory of this process that MEMORY_RLIMIT limits in MB, None if it's unknown
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(MEMORY_RLIMIT_STATUS):
+                    # in kB
+                    return int(line.split()[1]) / 2. ** 10
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _run_and_measure_rss(fnc, *args, **kwargs):
+    """ Runs on an engine, returns the result of fnc and the engine's resident memory in MB
+    """
+    result = fnc(*args, **kwargs)
+    return result, rss_mb()
+
+
+def _exit_engine(exit_code):
+    """ Runs on an engine, exits the engine with exit_code right after replying
+    """
+    exit_timer = threading.Timer(0.5, os._exit, [exit_code])
+    exit_timer.daemon = True
+    exit_timer.start()
+
+
+def _error_name(async_result):
+    """ Returns the name of the error a failed task raised on its engine
+    """
+    return getattr(async_result.exception(), 'ename', None)
+
+
+def _run_time(async_result):
+    """ Returns the seconds a finished task ran for on its engine
+    """
+    metadata = async_result.metadata
+    if metadata.get('started') and metadata.get('completed'):
+        return (metadata['completed'] - metadata['started']).total_seconds()
+    return 0.
+
+
+def _run_setup(fnc, setup):
+    """ Runs on an engine, calls setup so that the globals it assigns are visible to fnc
+
+    Functions serialized by value (e.g. by cloudpickle, for functions defined in __main__)
+    each get their own copy of their module's globals, so setup is run with fnc's globals
+    """
+    # look through the wrappers added for chunking, timeouts, memory limits and out-of-band serialization,
+    # which are partials of a runner with the wrapped function as first argument
+    while isinstance(fnc, functools.partial) and fnc.args and callable(fnc.args[0]):
+        fnc = fnc.args[0]
+    # only plain functions have globals to rebind, other callables (e.g. instances) are called as is
+    if (isinstance(setup, types.FunctionType) and isinstance(fnc, types.FunctionType)
+            and setup.__module__ == fnc.__module__ and setup.__globals__ is not fnc.__globals__):
+        for name, value in setup.__globals__.items():
+            fnc.__globals__.setdefault(name, value)
+        setup = types.FunctionType(setup.__code__, fnc.__globals__, setup.__name__,
+                                   setup.__defaults__, setup.__closure__)
+    setup()
+
+
+def _purge_hub_results(client, msg_ids):
+    """ Purge finished tasks from the controller's database, the controller must have seen them finish
+    """
+    from ipyparallel import RemoteError
+
+    try:
+        client.purge_hub_results(msg_ids)
+    except RemoteError as remote_err:
+        print("Failed to purge {} results from the controller: {}".format(len(msg_ids), remote_err))
@@ -0,0 +1,145 @@
+""" This module contains a per-engine LRU object cache
+
+Consecutive tasks on the same engine can reuse large objects instead of reloading them:
+
+    from ipp_tools import engine_cache
+
+    def my_task(path):
+        data = engine_cache.get(path, lambda: np.load(path))
+        ...
+
+The cache lives in the engine process, holds objects up to a memory budget and evicts the
+least recently used ones first. The budget defaults to $IPP_TOOLS_CACHE_MB (1024 MB if unset)
+and can be changed with configure, e.g. from slurm_map's setup.
+"""
+
+import os
+import socket
+import sys
+import threading
+
+from collections import OrderedDict
+
+from ipp_tools.utils import gather_engine_reports
+
+_LOCK = threading.RLock()
+_CACHE = OrderedDict()
+_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'n_bytes': 0}
+_CONFIG = {'max_bytes': int(float(os.environ.get('IPP_TOOLS_CACHE_MB', 1024)) * 2 ** 20)}
+
+
+def get(key, loader, n_bytes=None):
+    """ Returns the object cached under key, calling loader to load it on a miss
+
+    Args:
+      key: hashable key of the object
+      loader: callable with no arguments that loads the object
+      n_bytes: (optional) size of the object, estimated if not given
+
+    Returns:
+      obj: the cached or freshly loaded object
+    """
+    with _LOCK:
+        if key in _CACHE:
+            _CACHE.move_to_end(key)
+            _STATS['hits'] += 1
+            return _CACHE[key][0]
+        _STATS['misses'] += 1
+
+    obj = loader()
+    if n_bytes is None:
+        n_bytes = _sizeof(obj)
+
+    with _LOCK:
+        if n_bytes > _CONFIG['max_bytes']:
+            # larger than the whole cache, don't evict everything for it
+            return obj
+        if key in _CACHE:
+            _STATS['n_bytes'] -= _CACHE.pop(key)[1]
+        _CACHE[key] = (obj, n_bytes)
+        _STATS['n_bytes'] += n_bytes
+        _evict()
+    return obj
+
+
+def configure(max_mb):
+    """ Sets the memory budget of the cache in MB, evicting objects if it's now over budget
+    """
+    with _LOCK:
+        _CONFIG['max_bytes'] = int(max_mb * 2 ** 20)
+        _evict()
+
+
+def clear():
+    """ Empties the cache, keeping the statistics
+    """
+    with _LOCK:
+        _CACHE.clear()
+        _STATS['n_bytes'] = 0
+
+
+def stats():
+    """ Returns the hit/miss statistics of the cache in this process
+
+    Returns:
+      stats: dict of hits, misses, evictions, n_bytes and n_objects cached,
+        max_bytes, and the host and pid of this process
+    """
+    with _LOCK:
+        cache_stats = dict(_STATS)
+        cache_stats['n_objects'] = len(_CACHE)
+        cache_stats['max_bytes'] = _CONFIG['max_bytes']
+    cache_stats['host'] = socket.gethostname()
+    cache_stats['pid'] = os.getpid()
+    return cache_stats
+
+
+def report_stats(client, timeout=10):
+    """ Prints the cache statistics of every engine of client
+
+    Args:
+      client: ipyparallel Client connected to the cluster
+      timeout: seconds to wait for engines to report
+
+    Returns:
+      engine_stats: dict of engine id to stats, for engines that reported
+    """
+    engine_stats = gather_engine_reports(client, stats, 'cache stats', timeout=timeout)
+
+    n_hits = sum(cache_stats['hits'] for cache_stats in engine_stats.values())
+    n_misses = sum(cache_stats['misses'] for cache_stats in engine_stats.values())
+    if n_hits + n_misses == 0:
+        return engine_stats
+
+    print("Engine cache: {} hits, {} misses ({:.1f}% hit rate) over {} engines".format(
+        n_hits, n_misses, 100. * n_hits / (n_hits + n_misses), len(engine_stats)))
+    for engine_id, cache_stats in sorted(engine_stats.items()):
+        print("  engine {} ({}): {} hits, {} misses, {} evictions, {} objects, {:.0f} of {:.0f} MB".format(
+            engine_id, cache_stats['host'], cache_stats['hits'], cache_stats['misses'],
+            cache_stats['evictions'], cache_stats['n_objects'],
+            cache_stats['n_bytes'] / 2. ** 20, cache_stats['max_bytes'] / 2. ** 20))
+    return engine_stats
+
+
+def _evict():
+    """ Evicts least recently used objects until the cache is within budget, _LOCK must be held
+    """
+    while _CACHE and _STATS['n_bytes'] > _CONFIG['max_bytes']:
+        _, (_, n_bytes) = _CACHE.popitem(last=False)
+        _STATS['n_bytes'] -= n_bytes
+        _STATS['evictions'] += 1
+
+
+def _sizeof(obj, _depth=0):
+    """ Estimates the memory held by obj, counting array buffers and the items of containers
+    """
+    if hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    size = sys.getsizeof(obj)
+    if _depth < 3:
+        if isinstance(obj, dict):
+            size += sum(_sizeof(key, _depth + 1) + _sizeof(value, _depth + 1)
+                        for key, value in obj.items())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            size += sum(_sizeof(item, _depth + 1) for item in obj)
+    return size
@@ -0,0 +1,125 @@
+""" This module contains a per-engine pool for parallelism within tasks
+
+Engines allocated several CPUs usually run single-threaded task code. Tasks can fan sub-work
+out over all the CPUs of their engine:
+
+    from ipp_tools import local_map
+
+    def my_task(paths):
+        images = local_map(load_image, paths)
+        ...
+
+The pools live in the engine process and are created on first use, sized to the CPUs the
+engine may run on (its SLURM allocation), then reused by every later task on the engine.
+Process pools start fresh interpreters that each limit numerical libraries to one thread,
+so sub-tasks don't oversubscribe the engine's CPUs.
+"""
+
+import atexit
+import math
+import multiprocessing
+import os
+import sys
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from ipp_tools.utils import available_cpus, thread_env
+
+# sub-tasks are chunked so that each pool process gets about this many chunks
+CHUNKS_PER_PROCESS = 4
+
+_LOCK = threading.Lock()
+_POOLS = {}
+
+
+def local_map(fnc, iterable, use_threads=False, chunksize=None):
+    """ Map fnc over iterable on a pool of this process's CPUs, e.g. from within a task
+
+    Processes suit Python code that holds the GIL. fnc is serialized with cloudpickle if it's
+    available, so functions sent to engines by value work too. Threads suit code that releases
+    the GIL (NumPy, I/O) and avoid copying arguments and results between processes.
+
+    Args:
+      fnc: function to apply to each element of iterable
+      iterable: arguments of fnc
+      use_threads: (optional) if True, run on a thread pool instead of a process pool
+      chunksize: (optional) number of elements of iterable sent to a process at once,
+        defaults to spreading them over CHUNKS_PER_PROCESS chunks per process
+
+    Returns:
+      results: list of the results of fnc, in the order of iterable
+    """
+    args = list(iterable)
+    executor = _get_pool(use_threads)
+    if use_threads:
+        return list(executor.map(fnc, args))
+
+    if chunksize is None:
+        chunksize = max(1, int(math.ceil(len(args) / float(CHUNKS_PER_PROCESS * available_cpus()))))
+    chunks = [args[start:start + chunksize] for start in range(0, len(args), chunksize)]
+    pickled_fnc = _dumps(fnc)
+    results = []
+    for chunk_results in executor.map(_run_chunk, [pickled_fnc] * len(chunks), chunks):
+        results.extend(chunk_results)
+    return results
+
+
+def shutdown():
+    """ Shuts down the pools of this process, the next local_map creates new ones
+    """
+    with _LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for executor in pools:
+        executor.shutdown(wait=False)
+
+
+def _get_pool(use_threads):
+    """ Returns the thread or process pool of this process, creating it on first use
+    """
+    kind = 'threads' if use_threads else 'processes'
+    with _LOCK:
+        if kind not in _POOLS:
+            n_workers = available_cpus()
+            if use_threads:
+                _POOLS[kind] = ThreadPoolExecutor(n_workers)
+            else:
+                # engines run zmq threads, forking them directly isn't safe
+                method = 'forkserver' if sys.platform.startswith('linux') else 'spawn'
+                _POOLS[kind] = ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context(method),
+                                                   initializer=_init_process)
+        return _POOLS[kind]
+
+
+def _init_process():
+    """ Runs in each pool process before it loads any numerical library, limits them to one thread
+    """
+    os.environ.update(thread_env(1))
+
+
+def _run_chunk(pickled_fnc, chunk):
+    """ Runs in a pool process, applies fnc to each argument in chunk
+    """
+    fnc = _loads(pickled_fnc)
+    return [fnc(arg) for arg in chunk]
+
+
+def _dumps(obj):
+    """ Serializes obj with cloudpickle if it's available, pickle otherwise
+    """
+    try:
+        import cloudpickle as pickler
+    except ImportError:
+        import pickle as pickler
+    return pickler.dumps(obj)
+
+
+def _loads(data):
+    """ Inverts _dumps, cloudpickle output loads with pickle
+    """
+    import pickle
+    return pickle.loads(data)
+
+
+atexit.register(shutdown)
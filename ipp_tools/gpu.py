@@ -2,24 +2,62 @@
 
 """
 
-import numpy as np
+import socket
+import threading
+import time
 
-def assigned_gpu_is_free(gpu_id):
+try:
+    from subprocess import getstatusoutput
+except ImportError:
+    # Python 2
+    from commands import getstatusoutput
+
+# one row per GPU in a cluster snapshot, see cluster_gpu_snapshot
+GPU_SNAPSHOT_DTYPE = [
+    ('host', 'U64'),
+    ('gpu_id', 'i4'),
+    ('memory_used', 'f8'),
+    ('memory_total', 'f8'),
+    ('usage_frac', 'f8'),
+    ('n_processes', 'i4')
+]
+
+# nvidia-smi queries of every GPU, whatever its model, and of the processes using them
+GPU_QUERY_COMMAND = ('nvidia-smi --query-gpu=index,uuid,memory.used,memory.total,utilization.gpu'
+                     ' --format=csv,noheader,nounits')
+GPU_PROCESS_QUERY_COMMAND = 'nvidia-smi --query-compute-apps=gpu_uuid,pid --format=csv,noheader'
+
+def assigned_gpu_is_free(gpu_id, max_memory=0.1, max_usage=0.2, ignore_pids=()):
     """ Checks to see if gpu with gpu_id is free, returns True if so
+
+    Args:
+      gpu_id: id of the gpu as reported by nvidia-smi
+      max_memory: maximum fraction of memory in use for the GPU to count as free
+      max_usage: maximum utilization for the GPU to count as free
+      ignore_pids: (optional) pids whose GPU memory isn't counted, e.g. the calling process,
+        which may still hold memory from a previous job
+
+    Returns:
+      is_free: True if the gpu is free
     """
-    max_memory = 0.1
-    max_usage = 0.2
     gpu_id = int(gpu_id)
-    gpu_status = fetch_gpu_status()
-    gpu_ids = [gpu['id'] for gpu in gpu_status]
-    if gpu_id not in gpu_id:
+    gpu_status = {gpu['id']: gpu for gpu in fetch_gpu_status()}
+    if gpu_id not in gpu_status:
         print("GPU {} not found".format(gpu_id))
         return False
+    return gpu_is_free(gpu_status[gpu_id], max_memory, max_usage, ignore_pids)
+
+
+def gpu_is_free(gpu_status, max_memory=0.1, max_usage=0.2, ignore_pids=()):
+    """ Checks a gpu record returned by fetch_gpu_status, see assigned_gpu_is_free
 
-    gpu_idx = np.where(gpu_ids == gpu_id)[0].squeeze()
-    gpu_status = gpu_status[gpu_idx]
+    Returns:
+      is_free: True if the gpu is free
+    """
+    ignored_memory_frac = sum(process['mem_frac'] for process in gpu_status['processes']
+                              if process['pid'] in ignore_pids)
 
-    if gpu_status['memory_frac'] > max_memory:
+    if gpu_status['memory_frac'] - ignored_memory_frac > max_memory:
         print("Wired memory frac exceeds max")
         return False
 
@@ -27,14 +65,192 @@ def assigned_gpu_is_free(gpu_id):
         print("Volatile usage exceeds max")
         return False
 
+    return True
+
+
+def device_gpu_id(device):
+    """ Parses the gpu id out of a device string such as '/gpu:1'
+
+    Returns:
+      gpu_id: the gpu id, or None if device isn't a gpu
+    """
+    device_type, _, device_id = device.strip('/').partition(':')
+    if device_type.lower() != 'gpu':
+        return None
+    return int(device_id)
+
+
+def cluster_gpu_snapshot(client):
+    """ Query the status of every GPU on every host with an engine in the cluster
+
+    nvidia-smi is run on one engine per host, all hosts in parallel. Hosts where it fails,
+    e.g. hosts without GPUs, are left out
+
+    Args:
+      client: ipyparallel Client connected to the cluster
+
+    Returns:
+      snapshot: structured array with dtype GPU_SNAPSHOT_DTYPE, one row per GPU
+    """
+    engine_ids = client.ids
+    engine_hosts = client[engine_ids].apply_sync(socket.gethostname)
+
+    host_engines = {}
+    for engine_id, host in zip(engine_ids, engine_hosts):
+        host_engines.setdefault(host, engine_id)
+    hosts = sorted(host_engines)
+
+    import numpy as np
+
+    pending = [(host, client[host_engines[host]].apply_async(query_gpus)) for host in hosts]
+
+    rows = []
+    for host, async_result in pending:
+        try:
+            gpus = async_result.get()
+        except Exception as query_err:
+            print("Failed to query the GPUs of {}: {}".format(host, query_err))
+            continue
+        for gpu in gpus:
+            rows.append((host, gpu['id'], gpu['memory_used'], gpu['memory_total'],
+                         gpu['usage_frac'], gpu['n_processes']))
+    return np.array(rows, dtype=GPU_SNAPSHOT_DTYPE)
+
+
+def query_gpus():
+    """ Query the status of every GPU of this host with nvidia-smi
+
+    Returns:
+      gpus: list of dicts with the id, memory_used and memory_total in MiB, usage_frac
+        and n_processes of each GPU
+    """
+    status_code, output = getstatusoutput(GPU_QUERY_COMMAND)
+    if status_code != 0:
+        raise RuntimeError("nvidia-smi failed with status {}: {}".format(status_code, output))
+    status_code, process_output = getstatusoutput(GPU_PROCESS_QUERY_COMMAND)
+    if status_code != 0:
+        raise RuntimeError("nvidia-smi failed with status {}: {}".format(status_code, process_output))
+    return _parse_gpu_query(output, process_output)
+
+
+def _parse_gpu_query(output, process_output):
+    """ Parses the csv output of GPU_QUERY_COMMAND and GPU_PROCESS_QUERY_COMMAND, see query_gpus
+    """
+    process_gpus = [line.split(',')[0].strip() for line in process_output.splitlines() if line.strip()]
+    gpus = []
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        gpu_id, uuid, memory_used, memory_total, usage = [field.strip() for field in line.split(',')]
+        gpus.append({
+            'id': int(gpu_id),
+            'memory_used': _parse_number(memory_used),
+            'memory_total': _parse_number(memory_total),
+            'usage_frac': _parse_number(usage) / 100.,
+            'n_processes': process_gpus.count(uuid),
+        })
+    return gpus
+
+
+def _parse_number(field):
+    """ Parses a number reported by nvidia-smi, NaN if it's not available, e.g. '[N/A]'
+    """
+    try:
+        return float(field)
+    except ValueError:
+        return float('nan')
+
+
+def free_gpus(snapshot, max_memory=0.1, max_usage=0.2):
+    """ Select the GPUs in a cluster snapshot that are free
+
+    Args:
+      snapshot: structured array returned by cluster_gpu_snapshot
+      max_memory: maximum fraction of memory in use for a GPU to count as free
+      max_usage: maximum utilization for a GPU to count as free
+
+    Returns:
+      free: the rows of snapshot for the free GPUs
+    """
+    memory_frac = snapshot['memory_used'] / snapshot['memory_total']
+    is_free = (memory_frac <= max_memory) & (snapshot['usage_frac'] <= max_usage)
+    return snapshot[is_free]
+
+
+def start_gpu_sampler(gpu_id, interval=10.):
+    """ Starts sampling the utilization and memory of a gpu in a background thread
+
+    Args:
+      gpu_id: id of the gpu as reported by nvidia-smi
+      interval: seconds between samples
+
+    Returns:
+      stop: callable that stops sampling and returns the samples as a list of
+        (timestamp, usage_frac, memory_used) tuples
+    """
+    gpu_id = int(gpu_id)
+    samples = []
+    stop_event = threading.Event()
+
+    def sample():
+        while True:
+            try:
+                gpu_status = {gpu['id']: gpu for gpu in fetch_gpu_status()}
+                if gpu_id in gpu_status:
+                    samples.append((time.time(), gpu_status[gpu_id]['usage_frac'],
+                                    gpu_status[gpu_id]['memory_used']))
+            except Exception as err:
+                print("Failed to sample GPU {}: {}".format(gpu_id, err))
+            if stop_event.wait(interval):
+                return
+
+    sampler = threading.Thread(target=sample, name='gpu_sampler_{}'.format(gpu_id))
+    sampler.daemon = True
+    sampler.start()
+
+    def stop():
+        stop_event.set()
+        sampler.join()
+        return samples
+
+    return stop
+
+
+def summarize_gpu_samples(samples, end_time=None):
+    """ Summarizes the samples taken by start_gpu_sampler
+
+    Each sample is weighted by the time until the next sample (or end_time for the last one)
+
+    Returns:
+      summary: dict with the mean and peak usage fraction, peak memory used in MiB and
+        the GPU-seconds the gpu spent idle, None if there are no samples
+    """
+    if not samples:
+        return None
+    end_time = end_time or time.time()
+    timestamps = [sample[0] for sample in samples] + [max(end_time, samples[-1][0])]
+    durations = [next_time - sample_time for sample_time, next_time in zip(timestamps, timestamps[1:])]
+    total_duration = sum(durations)
+    usages = [sample[1] for sample in samples]
+
+    if total_duration > 0:
+        mean_usage = sum(usage * duration for usage, duration in zip(usages, durations)) / total_duration
+    else:
+        mean_usage = sum(usages) / len(usages)
+
+    return {
+        'n_samples': len(samples),
+        'mean_usage': mean_usage,
+        'peak_usage': max(usages),
+        'peak_memory': max(sample[2] for sample in samples),
+        'idle_gpu_seconds': sum((1. - usage) * duration for usage, duration in zip(usages, durations))
+    }
 
 
 def fetch_gpu_status():
     """ Run nvidia-smi and parse the output
-    requires Python 2 only dependency
     """
-    import commands
-    status_code, output = commands.getstatusoutput('nvidia-smi')
+    status_code, output = getstatusoutput('nvidia-smi')
     assert status_code == 0
 
     gpu_records = []
@@ -64,6 +280,7 @@ def fetch_gpu_status():
                     'power': physicals_tokens[3]
                 },
                 'memory_frac': float(memory_tokens[0][:-3]) / float(memory_tokens[2][:-3]),
+                'memory_used': int(memory_tokens[0][:-3]),
                 'tot_memory': int(memory_tokens[2][:-3]),
                 'usage_frac': float(usage_tokens[0][:-1]) / 100.,
                 'id': titan_id,
@@ -85,7 +302,7 @@ def fetch_gpu_status():
         # |    1     89398    C   python                                        2289MiB |-
         if process_block:
             disallowed_lines = ['+----', '|  GPU', '|======', '|    0 ']
-            invalid_line = np.asarray([line.startswith(illegal_line) for illegal_line in disallowed_lines]).any()
+            invalid_line = any(line.startswith(illegal_line) for illegal_line in disallowed_lines)
             if invalid_line:
                 continue
             gpu_id, pid, ptype, name, mem_usage = _strip_empty_str(_strip_empty_str(line.split('|'))[0].split(' '))
@@ -105,6 +322,6 @@ def fetch_gpu_status():
 def _strip_empty_str(tok_list):
     tokens = []
     for tok in tok_list:
-        if tok is not '':
+        if tok != '':
             tokens.append(tok)
     return tokens
@@ -0,0 +1,28 @@
+""" Launches an ipengine, recording when the phases of its startup finish, see ipp_tools.startup
+
+usage: python -m ipp_tools.launch_engine [ipengine arguments]
+"""
+
+import sys
+
+from ipp_tools import startup
+
+
+def main():
+    """ Runs ipengine with the command line arguments of this script
+    """
+    from ipyparallel.engine.app import IPEngine
+    startup.mark('imported')
+
+    load_connection_file = IPEngine.load_connection_file
+
+    def load_connection_file_and_mark(self):
+        load_connection_file(self)
+        startup.mark('connection_file')
+
+    IPEngine.load_connection_file = load_connection_file_and_mark
+    return IPEngine.launch_instance()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,50 @@
 """ This module contains logging related methods
 """
 
+import atexit
+import bisect
+import hashlib
+import hmac
+import json
 import logging
+import logging.handlers
 import os
+import socket
+import struct
+import threading
+import time
 
-def setup_logging(log_name, log_path):
+from six.moves import queue, socketserver
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# log file path -> QueueListener writing to it
+_LISTENERS = {}
+_LISTENERS_LOCK = threading.Lock()
+
+# QueueListener forwarding the records of this engine to the driver, see forward_engine_logs
+_ENGINE_FORWARDER = {}
+
+# length of the HMAC-SHA256 that authenticates each forwarded record
+_MAC_LEN = 32
+
+
+def setup_logging(log_name, log_path, reorder_window=1.):
     """ Sets up module level logging
+
+    Records are put on a queue and written to {log_path}/{log_name} by a background thread,
+    so logging never blocks on the file system. Records are written in order of creation
+    time, so records forwarded from engines interleave correctly with local ones.
+    Calling this again with the same arguments returns the logger without adding handlers.
+
+    Args:
+      log_name: name of the logger and of the log file
+      log_path: directory to write the log to, created if it doesn't exist
+      reorder_window: seconds a record is held back so that records arriving late
+        (e.g. from engines) can be written in order
+
+    Returns:
+      logger: the configured logger
     """
 
     # define module level logger
@@ -13,22 +52,264 @@ def setup_logging(log_name, log_path):
     logger.setLevel(logging.DEBUG)
 
     log_path = os.path.expanduser(log_path)
+    log_file = os.path.abspath('{}/{}'.format(log_path, log_name))
+
+    with _LISTENERS_LOCK:
+        for handler in logger.handlers:
+            if getattr(handler, 'log_file', None) == log_file:
+                return logger
 
-    if not os.path.exists(log_path):
-        os.makedirs(log_path, exist_ok=True)
+        if not os.path.exists(log_path):
+            os.makedirs(log_path, exist_ok=True)
 
-    # define file handler for module
-    fh = logging.FileHandler('{}/{}'.format(log_path, log_name))
-    fh.setLevel(logging.DEBUG)
+        if log_file not in _LISTENERS:
+            # define file handler for module, only ever touched by the writer thread
+            fh = logging.FileHandler(log_file, delay=True)
+            fh.setLevel(logging.DEBUG)
 
-    # create formatter and add to handler
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh.setFormatter(formatter)
+            # create formatter and add to handler
+            formatter = logging.Formatter(LOG_FORMAT)
+            fh.setFormatter(formatter)
 
-    # add handler to logger
-    logger.addHandler(fh)
+            listener = _FlushingQueueListener(queue.Queue(-1), _TimeOrderedHandler(fh, reorder_window),
+                                              flush_interval=reorder_window)
+            listener.start()
+            _LISTENERS[log_file] = listener
+
+        # add handler to logger
+        qh = logging.handlers.QueueHandler(_LISTENERS[log_file].queue)
+        qh.log_file = log_file
+        logger.addHandler(qh)
 
     # TODO: implement email handler
     # define email handler for important logs in module
     #eh = logging.SMTPHandler()
     return logger
+
+
+def forward_engine_logs(client, logger, level=logging.INFO, engine_ids=None, host=None):
+    """ Forward the log records of engines of client to logger
+
+    Engines send their records over TCP to a receiver thread on the driver, which hands
+    them to logger. Engines write to the socket from a background thread, so logging
+    in tasks never blocks on the network.
+
+    The receiver listens on every interface, like the controller, since hostnames often resolve
+    to a loopback address locally. Records are sent as JSON, each signed with a random key that
+    engines get over ipyparallel's authenticated channels, and the receiver drops connections
+    that send a record with an invalid signature.
+
+    Args:
+      client: ipyparallel Client connected to the cluster
+      logger: logger on the driver to aggregate the engine records in
+      level: minimum level of the records engines forward
+      engine_ids: (optional) engines to forward the records of, defaults to every engine.
+        More can be added later with add_engines
+      host: (optional) name of this host as engines reach it, defaults to its hostname
+
+    Returns:
+      forwarding: EngineLogForwarding, call its stop method to stop forwarding
+    """
+    return EngineLogForwarding(client, logger, level, host).add_engines(
+        client.ids if engine_ids is None else engine_ids)
+
+
+class EngineLogForwarding(object):
+    """ Receiver of the log records of engines, see forward_engine_logs
+    """
+
+    def __init__(self, client, logger, level, host=None):
+        self.client = client
+        self.level = level
+        self.host = host or socket.gethostname()
+        self.key = os.urandom(_MAC_LEN)
+        self.engine_ids = []
+
+        self.receiver = socketserver.ThreadingTCPServer(('', 0), _LogRecordStreamHandler)
+        self.receiver.daemon_threads = True
+        self.receiver.logger = logger
+        self.receiver.key = self.key
+        receiver_thread = threading.Thread(target=self.receiver.serve_forever, name='engine_log_receiver')
+        receiver_thread.daemon = True
+        receiver_thread.start()
+        self.port = self.receiver.server_address[1]
+
+    def add_engines(self, engine_ids, block=True):
+        """ Start forwarding the records of engine_ids
+
+        Returns:
+          forwarding: this EngineLogForwarding
+        """
+        engine_ids = list(engine_ids)
+        if engine_ids:
+            async_result = self.client[engine_ids].apply_async(
+                _start_engine_forwarding, self.host, self.port, self.level, self.key)
+            if block:
+                async_result.get()
+            self.engine_ids.extend(engine_ids)
+            self.receiver.logger.info("Forwarding logs of %s engines to %s:%s",
+                                      len(engine_ids), self.host, self.port)
+        return self
+
+    def stop(self):
+        """ Stop forwarding on the engines that are still registered and shut down the receiver
+
+        Doesn't wait for the engines, which only stop forwarding once their running task is done.
+        Records they send after the receiver is shut down are dropped
+        """
+        registered_engines = set(self.client.ids)
+        engine_ids = [engine_id for engine_id in self.engine_ids if engine_id in registered_engines]
+        try:
+            if engine_ids:
+                self.client[engine_ids].apply_async(_stop_engine_forwarding)
+        except Exception as stop_err:
+            print("Failed to stop forwarding engine logs: {}".format(stop_err))
+        finally:
+            self.receiver.shutdown()
+            self.receiver.server_close()
+
+
+def _start_engine_forwarding(host, port, level, key):
+    """ Runs on an engine, sends the engine's log records to host:port in the background, signed with key
+    """
+    _stop_engine_forwarding()
+
+    engine_name = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def tag_engine(record):
+        record.name = '{}[{}]'.format(record.name, engine_name)
+        return True
+
+    socket_handler = _SignedSocketHandler(host, port, key)
+    socket_handler.addFilter(tag_engine)
+    listener = logging.handlers.QueueListener(queue.Queue(-1), socket_handler)
+    listener.start()
+
+    queue_handler = logging.handlers.QueueHandler(listener.queue)
+    queue_handler.setLevel(level)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(queue_handler)
+    if root_logger.level > level:
+        root_logger.setLevel(level)
+    _ENGINE_FORWARDER['listener'] = listener
+    _ENGINE_FORWARDER['handler'] = queue_handler
+
+
+def _stop_engine_forwarding():
+    """ Runs on an engine, stops forwarding started by _start_engine_forwarding
+    """
+    if _ENGINE_FORWARDER:
+        logging.getLogger().removeHandler(_ENGINE_FORWARDER.pop('handler'))
+        listener = _ENGINE_FORWARDER.pop('listener')
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+class _SignedSocketHandler(logging.handlers.SocketHandler):
+    """ SocketHandler that sends records as signed JSON instead of pickles
+    """
+
+    def __init__(self, host, port, key):
+        logging.handlers.SocketHandler.__init__(self, host, port)
+        self.key = key
+
+    def makePickle(self, record):
+        if record.exc_info:
+            # fills in record.exc_text
+            self.format(record)
+        record_dict = dict(record.__dict__)
+        record_dict['msg'] = record.getMessage()
+        record_dict['args'] = None
+        record_dict['exc_info'] = None
+        record_dict.pop('message', None)
+        payload = json.dumps(record_dict, default=str).encode('utf-8')
+        mac = hmac.new(self.key, payload, hashlib.sha256).digest()
+        return struct.pack('>L', len(payload)) + mac + payload
+
+
+class _LogRecordStreamHandler(socketserver.StreamRequestHandler):
+    """ Reads signed log records sent by a _SignedSocketHandler and hands them to the server's logger
+
+    Stops reading from a connection at its first record with an invalid signature
+    """
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(4 + _MAC_LEN)
+            if len(header) < 4 + _MAC_LEN:
+                return
+            record_len = struct.unpack('>L', header[:4])[0]
+            payload = self.rfile.read(record_len)
+            expected_mac = hmac.new(self.server.key, payload, hashlib.sha256).digest()
+            if len(payload) < record_len or not hmac.compare_digest(header[4:], expected_mac):
+                print("Dropping log connection from {}: invalid record".format(self.client_address[0]))
+                return
+            try:
+                record = logging.makeLogRecord(json.loads(payload.decode('utf-8')))
+            except ValueError:
+                return
+            self.server.logger.handle(record)
+
+
+class _TimeOrderedHandler(logging.Handler):
+    """ Holds records back for window seconds and passes them on to target ordered by creation time
+    """
+
+    def __init__(self, target, window):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.window = window
+        self.buffer = []
+
+    def emit(self, record):
+        bisect.insort(self.buffer, (record.created, id(record), record))
+        self.flush()
+
+    def flush(self, cutoff=None):
+        if cutoff is None:
+            cutoff = time.time() - self.window
+        self.acquire()
+        try:
+            n_ready = bisect.bisect(self.buffer, (cutoff, float('inf')))
+            ready, self.buffer = self.buffer[:n_ready], self.buffer[n_ready:]
+            for _, _, record in ready:
+                if record.levelno >= self.target.level:
+                    self.target.handle(record)
+            self.target.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush(cutoff=float('inf'))
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class _FlushingQueueListener(logging.handlers.QueueListener):
+    """ QueueListener that flushes its handlers whenever the queue has been idle for flush_interval
+    """
+
+    def __init__(self, log_queue, *handlers, **kwargs):
+        self.flush_interval = kwargs.pop('flush_interval')
+        logging.handlers.QueueListener.__init__(self, log_queue, *handlers, **kwargs)
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_interval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+
+
+@atexit.register
+def _stop_listeners():
+    """ Write out everything still queued before the interpreter exits
+    """
+    with _LISTENERS_LOCK:
+        for listener in _LISTENERS.values():
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        _LISTENERS.clear()
@@ -1,15 +1,18 @@
 """ This module contains methods providing a high-level map interface to an ipp cluster
 """
 
+import csv
 import six
 import socket
 import os
 import time
 
-import numpy as np
+from warnings import warn
 
-from ipp_tools.gpu import fetch_gpu_status
-from ipp_tools.log_tools import setup_logging
+from six.moves.queue import Queue, Empty
+
+from ipp_tools.gpu import device_gpu_id, fetch_gpu_status, gpu_is_free, start_gpu_sampler, summarize_gpu_samples
+from ipp_tools.log_tools import setup_logging, forward_engine_logs
 
 WS_N_GPUS = {
     'turagas-ws1': 2,
@@ -22,35 +25,93 @@ WS_N_GPUS = {
     'c04u17': 8,
 }
 
-def assigned_gpu_is_free(gpu_id):
-    """ Checks to see if gpu with gpu_id is free, returns True if so
+TELEMETRY_FIELDS = ['job_idx', 'engine_id', 'device', 'run_time', 'n_samples',
+                    'mean_usage', 'peak_usage', 'peak_memory', 'idle_gpu_seconds']
+
+def _run_gpu_job(job_fnc, job_arg, device, admission=None, telemetry_interval=None,
+                 compress=None, compress_threshold=None):
+    """ Runs job_fnc on the engine
+
+    Args:
+      admission: (optional) dict of max_memory, max_usage and admission_patience;
+        if given, waits for the device to be free before running, see _wait_for_device
+      telemetry_interval: (optional) if given, the device is sampled every
+        telemetry_interval seconds while the job runs
+      compress: (optional) codec to compress the returned values with, see ipp_tools.serialization
+      compress_threshold: (optional) buffers smaller than this many bytes aren't compressed
+
+    Returns:
+      result: the return value of job_fnc
+      telemetry: summary of the device samples, see summarize_gpu_samples, along with the device
+      run_time: seconds job_fnc ran for, not counting the wait for the device
     """
-    max_memory = 0.1
-    max_usage = 0.2
-    gpu_id = int(gpu_id)
-    gpu_status = fetch_gpu_status()
-    gpu_ids = [gpu['id'] for gpu in gpu_status]
-    if gpu_id not in gpu_id:
-        print("GPU {} not found".format(gpu_id))
-        return False
+    gpu_id = device_gpu_id(device)
+    if admission is not None and gpu_id is not None:
+        _wait_for_device(device, **admission)
+
+    if telemetry_interval is None or gpu_id is None:
+        run_start = time.time()
+        result, telemetry = job_fnc(job_arg, device), None
+        run_time = time.time() - run_start
+    else:
+        stop_sampler = start_gpu_sampler(gpu_id, telemetry_interval)
+        run_start = time.time()
+        try:
+            result = job_fnc(job_arg, device)
+        finally:
+            run_time = time.time() - run_start
+            samples = stop_sampler()
+
+        telemetry = summarize_gpu_samples(samples)
+        if telemetry is not None:
+            telemetry['device'] = device
 
-    gpu_idx = np.where(gpu_ids == gpu_id)[0].squeeze()
-    gpu_status = gpu_status[gpu_idx]
+    if compress is not None:
+        from ipp_tools.serialization import wrap_result
+        return wrap_result((result, telemetry, run_time), compress, compress_threshold)
+    return result, telemetry, run_time
 
-    if gpu_status['memory_frac'] > max_memory:
-        print("Wired memory frac exceeds max")
-        return False
 
-    if gpu_status['usage_frac'] > max_usage:
-        print("Volatile usage exceeds max")
-        return False
+def _wait_for_device(device, max_memory, max_usage, admission_patience, max_backoff=120):
+    """ Blocks until device is free
+
+    Backs off exponentially while the device is busy. If it is still busy after
+    admission_patience seconds, raises UnmetDependency so that the scheduler hands
+    the job to another engine. If the status of the device can't be read, e.g. nvidia-smi
+    fails or doesn't list the device, the job is admitted with a warning.
+    """
+    from ipyparallel.error import UnmetDependency
+
+    gpu_id = device_gpu_id(device)
+    wait_start = time.time()
+    backoff = 5
+    while True:
+        try:
+            gpu_status = {gpu['id']: gpu for gpu in fetch_gpu_status()}
+        except Exception as status_err:
+            warn("Failed to read the status of {}, admitting the job: {!r}".format(device, status_err))
+            return
+        if gpu_id not in gpu_status:
+            warn("{} not found in the GPU status, admitting the job".format(device))
+            return
+        if gpu_is_free(gpu_status[gpu_id], max_memory, max_usage, ignore_pids=[os.getpid()]):
+            return
+        waited = time.time() - wait_start
+        if waited >= admission_patience:
+            raise UnmetDependency("{} busy after {:.0f} seconds".format(device, waited))
+        time.sleep(min(backoff, admission_patience - waited))
+        backoff = min(2 * backoff, max_backoff)
 
 
 def gpu_job_runner(job_fnc, job_args, ipp_profile='ssh_gpu_py2', log_name=None, log_dir='~/logs/default',
-                   status_interval=600, allow_engine_overlap=True, devices_assigned=False):
+                   status_interval=600, allow_engine_overlap=True, devices_assigned=False,
+                   job_callback=None, admission_control=True, max_memory=0.1, max_usage=0.2,
+                   admission_patience=1800, telemetry_interval=10, forward_logs=True,
+                   compress=None, compress_threshold=2 ** 16):
     """ Distribute a set of jobs across an IPyParallel 'GPU cluster'
     Requires that cluster has already been started with `ipcluster start --profile={}`.forat(ipp_profile)
-    Checks on the jobs every status_interval seconds, logging status.
+    Each job is tracked individually as it completes; throughput, ETA and per-engine
+    utilization are logged every status_interval seconds.
 
     Args:
       job_fnc: the function to distribute
@@ -61,11 +122,30 @@ def gpu_job_runner(job_fnc, job_args, ipp_profile='ssh_gpu_py2', log_name=None,
       ipp_profile: profile of GPU IPyParallel profile - str
       log_name: (optional) name for log
       log_dir: (optional), default is ~/logs/default which is created if it doesn't exist
-      status_interval: (optional) the amount of time, in seconds, to wait before querying the AsyncResult
-       object for the status of the jobs
+      status_interval: (optional) the amount of time, in seconds, between progress reports
       devices_assigned: (optional) set this to True if devices have already been assigned to
         the engines on this cluster
+      job_callback: (optional) called with the job record of each job as soon as it finishes.
+        Runs in the calling thread, so it is free to block or to launch follow-up jobs
+      admission_control: (optional) if True, each engine waits for its device to be free
+        before starting a job, see assigned_gpu_is_free
+      max_memory: (optional) maximum fraction of device memory used by other processes
+        for the device to be considered free
+      max_usage: (optional) maximum device utilization for the device to be considered free
+      admission_patience: (optional) seconds an engine waits for its device before handing
+        the job to another engine. A job refused by every engine fails
+      telemetry_interval: (optional) seconds between samples of each job's device utilization
+        and memory. A summary for each job is logged and written to {log_name}_gpu_telemetry.csv
+        in log_dir. Set to None to disable
+      forward_logs: (optional) if True, log records emitted on the engines are written to
+        this job runner's log as well
+      compress: (optional) name of a codec in ipp_tools.serialization.CODECS to compress
+        job args and returned values with
+      compress_threshold: (optional) buffers smaller than this many bytes aren't compressed
 
+    Returns:
+      job_records: list of dicts, one per job in job_args, with the AsyncResult of the job
+        along with its submission and finish times, engine id, run time and device telemetry
     """
     from ipyparallel import Client, RemoteError, Reference
     import inspect
@@ -76,23 +156,24 @@ def gpu_job_runner(job_fnc, job_args, ipp_profile='ssh_gpu_py2', log_name=None,
     logger = setup_logging(log_name, log_path)
 
     # TODO: this isn't strictly necessary
-    try:
-        # check that job_fnc accepts a device kwarg
-        args = inspect.getargspec(job_fnc)[0]
-        assert 'device' in args
-    except AssertionError:
+    # check that job_fnc accepts a device kwarg
+    if 'device' not in inspect.signature(job_fnc).parameters:
         logger.critical("job_fnc does not except device kwarg. Halting.")
 
     client = Client(profile=ipp_profile)
 
     logger.info("Succesfully initialized client on %s with %s engines", ipp_profile, len(client))
 
+    if forward_logs:
+        log_forwarding = forward_engine_logs(client, logger)
 
     if not devices_assigned:
         # assign each engine to a GPU
         engines_per_host = {}
         device_assignments = []
-        engine_hosts = client[:].apply(socket.gethostname).get()
+        engine_ids = client.ids
+        dview = client[engine_ids]
+        engine_hosts = dview.apply_sync(socket.gethostname)
 
         for host in engine_hosts:
             if host in engines_per_host:
@@ -117,16 +198,24 @@ def gpu_job_runner(job_fnc, job_args, ipp_profile='ssh_gpu_py2', log_name=None,
         while True:
             try:
                 # NOTE: could also be accomplished with process environment variables
-                # broadcast device assignments and job_fnc
-                for engine_id, engine_device in enumerate(device_assignments):
-                    print("Pushing to engine {}: device: {}".format(engine_id, engine_device))
-                    client[engine_id].push({'device': engine_device,
-                                            'job_fnc': job_fnc})
-
-                for engine_id, (host, assigned_device) in enumerate(zip(engine_hosts, device_assignments)):
-                    remote_device = client[engine_id].pull('device').get()
+                # scatter one device to each engine and broadcast job_fnc, both in flight at once
+                setup_start_time = time.time()
+                pending = [dview.scatter('device', device_assignments, flatten=True, block=False),
+                           dview.push({'job_fnc': job_fnc}, block=False)]
+                for async_result in pending:
+                    async_result.get()
+
+                # verify every assignment with a single batched pull
+                remote_devices = dview.pull('device', block=True)
+                for engine_id, host, assigned_device, remote_device in zip(
+                        engine_ids, engine_hosts, device_assignments, remote_devices):
                     logger.info("Engine %s: host = %s; device = %s, remote device = %s",
                                 engine_id, host, assigned_device, remote_device)
+                    if remote_device != assigned_device:
+                        logger.critical("Engine %s reports device %s, expected %s",
+                                        engine_id, remote_device, assigned_device)
+                logger.info("Assigned devices to %s engines in %.2f seconds",
+                            len(engine_ids), time.time() - setup_start_time)
                 break
             except RemoteError as remote_err:
                 logger.warn("Caught remote error: %s. Sleeping for 10s before retry", remote_err)
@@ -138,16 +227,133 @@ def gpu_job_runner(job_fnc, job_args, ipp_profile='ssh_gpu_py2', log_name=None,
             logger.warn('Caught remote error when checking device assignments: %s. You may want to initialize device assignments', remote_err)
 
     logger.info("Dispatching jobs: %s", job_args)
-    # dispatch jobs
-    async_result = client[:].map(job_fnc, job_args, [Reference('device')] * len(job_args))
-
+    # dispatch jobs one at a time so that each job completes (and is tracked) individually
+    lb_view = client.load_balanced_view()
+    job_records = []
+    finished_jobs = Queue()
     start_time = time.time()
+    if admission_control:
+        admission = {'max_memory': max_memory, 'max_usage': max_usage,
+                     'admission_patience': admission_patience}
+    else:
+        admission = None
+    if compress is not None:
+        from ipp_tools.serialization import OOBPayload, register_canning
+        register_canning()
+    # job_fnc was pushed to every engine along with the devices, tasks only refer to it by name
+    sent_fnc = job_fnc if devices_assigned else Reference('job_fnc')
+    for job_idx, job_arg in enumerate(job_args):
+        sent_arg = OOBPayload(job_arg, compress, compress_threshold) if compress is not None else job_arg
+        async_result = lb_view.apply_async(_run_gpu_job, sent_fnc, sent_arg, Reference('device'),
+                                           admission, telemetry_interval, compress, compress_threshold)
+        job_records.append({
+            'job_idx': job_idx,
+            'job_arg': job_arg,
+            'async_result': async_result,
+            'submitted': time.time(),
+            'finished': None,
+            'engine_id': None,
+            'run_time': None,
+            'telemetry': None
+        })
+        # called from the client's IO thread, so only hand off to the driver loop here
+        async_result.add_done_callback(
+            lambda _, job_idx=job_idx: finished_jobs.put((job_idx, time.time())))
+
+    if telemetry_interval is not None:
+        telemetry_path = '{}/{}_gpu_telemetry.csv'.format(log_path, log_name)
+        telemetry_file = open(telemetry_path, 'w')
+        telemetry_writer = csv.DictWriter(telemetry_file, TELEMETRY_FIELDS)
+        telemetry_writer.writeheader()
+        logger.info("Writing GPU telemetry to %s", telemetry_path)
+
+    n_jobs = len(job_records)
+    n_finished = 0
+    next_status_time = start_time + status_interval
+    while n_finished < n_jobs:
+        try:
+            job_idx, finish_time = finished_jobs.get(timeout=max(next_status_time - time.time(), 0))
+        except Empty:
+            _log_job_progress(logger, job_records, start_time)
+            next_status_time = time.time() + status_interval
+            continue
+
+        n_finished += 1
+        job_record = job_records[job_idx]
+        _record_job_finish(job_record, finish_time)
+        if job_record['async_result'].successful():
+            logger.info("Job %s finished on engine %s after %.1f seconds",
+                        job_idx, job_record['engine_id'], job_record['run_time'])
+            telemetry = job_record['telemetry']
+            if telemetry is not None:
+                logger.info("Job %s GPU usage: mean %.0f%%, peak %.0f%%; peak memory %s MiB; "
+                            "%.0f GPU-seconds idle",
+                            job_idx, 100 * telemetry['mean_usage'], 100 * telemetry['peak_usage'],
+                            telemetry['peak_memory'], telemetry['idle_gpu_seconds'])
+                telemetry_row = {'job_idx': job_idx, 'engine_id': job_record['engine_id'],
+                                 'run_time': job_record['run_time']}
+                telemetry_row.update(telemetry)
+                telemetry_writer.writerow(telemetry_row)
+                telemetry_file.flush()
+        else:
+            logger.error("Job %s failed on engine %s: %s",
+                         job_idx, job_record['engine_id'], job_record['async_result'].exception())
+
+        if job_callback is not None:
+            job_callback(job_record)
+
+        if time.time() >= next_status_time:
+            _log_job_progress(logger, job_records, start_time)
+            next_status_time = time.time() + status_interval
+
+    if telemetry_interval is not None:
+        telemetry_file.close()
+
+    if forward_logs:
+        log_forwarding.stop()
+
+    _log_job_progress(logger, job_records, start_time)
+    logger.info("All jobs finished in %.1f seconds!", time.time() - start_time)
+    return job_records
+
+
+def _record_job_finish(job_record, finish_time):
+    """ Fill in the finish time, engine and run time of a completed job record
+
+    The run time of a successful job is the time job_fnc ran for, excluding the wait for its device
+    """
+    metadata = job_record['async_result'].metadata
+    job_record['finished'] = finish_time
+    job_record['engine_id'] = metadata.get('engine_id')
+    if job_record['async_result'].successful():
+        _, job_record['telemetry'], job_record['run_time'] = job_record['async_result'].get()
+    elif metadata.get('started') and metadata.get('completed'):
+        job_record['run_time'] = (metadata['completed'] - metadata['started']).total_seconds()
+    else:
+        job_record['run_time'] = finish_time - job_record['submitted']
+
+
+def _log_job_progress(logger, job_records, start_time):
+    """ Log throughput, ETA and per-engine utilization of the jobs in job_records
+    """
+    wall_time = time.time() - start_time
+    finished = [record for record in job_records if record['finished'] is not None]
+    n_finished = len(finished)
+    n_jobs = len(job_records)
+
+    throughput = n_finished / wall_time if wall_time > 0 else 0.
+    if n_finished == n_jobs:
+        eta = 0.
+    elif throughput > 0:
+        eta = (n_jobs - n_finished) / throughput
+    else:
+        eta = float('nan')
+    logger.info("%.1f seconds elapsed. %s of %s jobs finished. %.3f jobs/hour. ETA: %.1f seconds",
+                wall_time, n_finished, n_jobs, throughput * 3600, eta)
 
-    while not async_result.ready():
-        time.sleep(status_interval)
-        n_finished = async_result.progress
-        n_jobs = len(job_args)
-        wall_time = start_time - time.time()
-        logger.info("%s seconds elapsed. %s of %s jobs finished",
-                    wall_time, n_finished, n_jobs)
-    logger.info("All jobs finished in %s seconds!", async_result.wall_time)
+    busy_time = {}
+    for record in finished:
+        busy_time[record['engine_id']] = busy_time.get(record['engine_id'], 0.) + record['run_time']
+    for engine_id, engine_busy_time in sorted(busy_time.items(), key=lambda item: str(item[0])):
+        logger.info("Engine %s: utilization %.1f%%", engine_id,
+                    100. * min(engine_busy_time / wall_time, 1.) if wall_time > 0 else 0.)
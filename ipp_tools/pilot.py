@@ -0,0 +1,158 @@
+""" This module contains pilot runs, which size a slurm_map from a sample of its tasks
+
+A pilot run executes the first few tasks locally, each in a fresh process, and measures how
+long they take and how much memory they need. recommend_resources turns these measurements
+into a resource spec and chunksize that finish the whole map in a target wall-clock time.
+"""
+
+import math
+import multiprocessing
+import os
+import time
+
+from ipp_tools.engine_pool import _dumps, _loads
+from ipp_tools.utils import rss_mb
+
+# engines get this much more memory than the largest pilot task needed
+MEMORY_HEADROOM = 1.5
+# memory of an idle engine and of an idle pool process, on top of what tasks need
+ENGINE_BASE_MB = 256
+PROCESS_BASE_MB = 64
+# worker_mem_mb is rounded up to a multiple of this
+MEMORY_STEP_MB = 512
+
+# tasks are chunked until a chunk runs for about this long, to amortize dispatch overhead
+TARGET_CHUNK_SECONDS = 1.
+# keep at least this many chunks per worker, so that the load stays balanced
+MIN_CHUNKS_PER_WORKER = 4
+
+# fraction of the available memory of this node a local pool may use
+LOCAL_MEMORY_FRACTION = 0.8
+
+
+def pilot_run(fnc, args, setup=None, n_processes=None):
+    """ Run fnc on each of args locally, one fresh process per task, and measure it
+
+    Args:
+      fnc: function to apply to each element of args. fnc and setup are serialized with
+        cloudpickle if it's available, as for engines, so they may be lambdas or closures
+      args: list of sample arguments of fnc
+      setup: (optional) callable run in each process before its task, as on an engine.
+        Its time isn't counted towards the task's
+      n_processes: (optional) number of tasks to run concurrently, defaults to the number of CPUs
+
+    Returns:
+      results: list of the results of fnc, in the order of args
+      stats: dict with lists of the run_seconds, setup_seconds and task_rss_mb of each task.
+        task_rss_mb is the peak resident memory its process gained during setup and the task
+    """
+    n_processes = n_processes or min(len(args), multiprocessing.cpu_count())
+    print("Pilot run of {} tasks on {} processes".format(len(args), n_processes))
+    pool = multiprocessing.Pool(n_processes, maxtasksperchild=1)
+    try:
+        pickled_fncs = _dumps((fnc, setup))
+        pending = [pool.apply_async(_measure_task, (pickled_fncs, arg)) for arg in args]
+        measurements = [async_result.get() for async_result in pending]
+    finally:
+        pool.terminate()
+
+    results = [measurement[0] for measurement in measurements]
+    stats = {
+        'setup_seconds': [measurement[1] for measurement in measurements],
+        'run_seconds': [measurement[2] for measurement in measurements],
+        'task_rss_mb': [measurement[3] for measurement in measurements],
+    }
+    return results, stats
+
+
+def recommend_resources(stats, n_tasks, target_seconds, resource_spec):
+    """ Derive a resource spec and chunksize from pilot run statistics
+
+    Args:
+      stats: stats returned by pilot_run
+      n_tasks: total number of tasks in the map
+      target_seconds: wall-clock time the tasks should finish in, once engines are running
+      resource_spec: resource spec to start from, as returned by process_resource_spec
+
+    Returns:
+      resource_spec: copy of resource_spec with max_workers, min_workers and worker_mem_mb set
+      chunksize: number of tasks to run as one
+    """
+    mean_seconds = max(sum(stats['run_seconds']) / len(stats['run_seconds']), 1e-3)
+    max_seconds = max(stats['run_seconds'])
+    peak_mb = max(stats['task_rss_mb'])
+
+    # never more workers than tasks
+    n_workers = int(math.ceil(n_tasks * mean_seconds / target_seconds))
+    n_workers = max(1, min(n_workers, n_tasks))
+
+    chunksize = int(math.ceil(TARGET_CHUNK_SECONDS / mean_seconds))
+    chunksize = max(1, min(chunksize, n_tasks // (MIN_CHUNKS_PER_WORKER * n_workers)))
+
+    mem_mb = int(math.ceil((ENGINE_BASE_MB + peak_mb * MEMORY_HEADROOM) / MEMORY_STEP_MB)) * MEMORY_STEP_MB
+
+    recommended_spec = dict(resource_spec)
+    recommended_spec['max_workers'] = n_workers
+    recommended_spec['min_workers'] = min(resource_spec['min_workers'], n_workers)
+    recommended_spec['worker_mem_mb'] = mem_mb
+
+    print("Pilot tasks took {:.2f} seconds on average ({:.2f} at most) and up to {:.0f} MB".format(
+        mean_seconds, max_seconds, peak_mb))
+    print("Recommended for {} tasks in {:.0f} seconds: max_workers={}, worker_mem_mb={}, chunksize={}".format(
+        n_tasks, target_seconds, n_workers, mem_mb, chunksize))
+    if max_seconds > target_seconds:
+        print("Warning: the slowest pilot task alone took longer than {:.0f} seconds".format(target_seconds))
+
+    return recommended_spec, chunksize
+
+
+def choose_backend(stats, n_tasks, resource_spec, startup_seconds):
+    """ Decide whether launching a cluster is worth its startup time, from pilot run statistics
+
+    Compares the estimated wall-clock time of running the tasks on a local process pool,
+    sized to the CPUs and memory of this node, with that of starting the cluster and
+    running them on max_workers engines. Tasks that need GPUs always run on the cluster.
+
+    Args:
+      stats: stats returned by pilot_run
+      n_tasks: number of tasks to run
+      resource_spec: resource spec of the cluster, as returned by process_resource_spec
+      startup_seconds: seconds it takes to start the controller and engines
+
+    Returns:
+      backend: 'local' or 'slurm'
+      n_processes: size of the local pool
+    """
+    from ipp_tools.utils import available_cpus
+
+    mean_seconds = sum(stats['run_seconds']) / len(stats['run_seconds'])
+    peak_mb = max(stats['task_rss_mb'])
+
+    available_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') / 2. ** 20
+    n_processes = max(1, min(available_cpus(), int(LOCAL_MEMORY_FRACTION * available_mb / (PROCESS_BASE_MB + peak_mb)), n_tasks))
+
+    local_seconds = math.ceil(n_tasks / float(n_processes)) * mean_seconds
+    slurm_seconds = startup_seconds + math.ceil(n_tasks / float(resource_spec['max_workers'])) * mean_seconds
+    print("Estimated {:.0f} seconds on {} local processes, {:.0f} seconds on {} engines".format(
+        local_seconds, n_processes, slurm_seconds, resource_spec['max_workers']))
+
+    if resource_spec['worker_n_gpus'] > 0 or slurm_seconds < local_seconds:
+        return 'slurm', n_processes
+    return 'local', n_processes
+
+
+def _measure_task(pickled_fncs, arg):
+    """ Runs in a pool process, returns the result of fnc with its timings and the memory it gained
+
+    The process is forked from the driver, so its resident memory starts out with the driver's
+    pages. Only the increase of the peak over that is counted.
+    """
+    start_rss_mb = rss_mb()
+    fnc, setup = _loads(pickled_fncs)
+    setup_start = time.time()
+    if setup is not None:
+        setup()
+    run_start = time.time()
+    result = fnc(arg)
+    run_end = time.time()
+    return result, run_start - setup_start, run_end - run_start, max(rss_mb(peak=True) - start_rss_mb, 0.)
@@ -0,0 +1,85 @@
+""" This module contains the local process pool backend of slurm_map
+"""
+
+import collections
+import functools
+import multiprocessing
+import os
+
+from warnings import warn
+
+from ipp_tools.dispatch import TaskTimeout, chunk_tasks, unchunk_results, with_timeout
+from ipp_tools.utils import available_cpus, thread_env
+
+
+def pool_map(fnc, iterable, n_processes=None, setup=None, chunksize=1, max_in_flight=None, task_timeout=None,
+             max_tasks_per_process=None):
+    """ Map fnc over iterable on a local process pool, keeping a bounded number of tasks in flight
+
+    Behaves like windowed_map on a cluster: iterable is consumed lazily, setup runs once
+    in each process before it gets any tasks, results are returned in the order of iterable
+    and the first failed task raises its exception. Tasks that time out aren't retried,
+    their result is the TaskTimeout error.
+    fnc and setup must be picklable, e.g. defined at the top level of a module.
+    Processes share the CPUs between the thread pools of the numerical libraries they load,
+    libraries the parent process already loaded keep their thread pools.
+
+    Args:
+      fnc: function to apply to each element of iterable
+      iterable: arguments of fnc, one task per element
+      n_processes: (optional) number of worker processes, defaults to the available CPUs
+      setup: (optional) callable run once in each worker process
+      chunksize: (optional) number of elements of iterable sent to a process as one task
+      max_in_flight: (optional) maximum number of chunks submitted but not collected,
+        defaults to twice the number of processes
+      task_timeout: (optional) seconds a chunk may run for. None disables timeouts
+      max_tasks_per_process: (optional) replace worker processes after this many chunks
+
+    Returns:
+      results: list of the results of fnc, in the order of iterable
+    """
+    n_processes = n_processes or available_cpus()
+    window = max_in_flight or 2 * n_processes
+    chunk_fnc, chunks, chunk_lengths = chunk_tasks(fnc, iterable, chunksize)
+    if task_timeout is not None:
+        chunk_fnc = with_timeout(chunk_fnc, task_timeout)
+
+    print("Running tasks on a local pool of {} processes".format(n_processes))
+    n_threads = max(1, available_cpus() // n_processes)
+    initializer = functools.partial(_init_process, n_threads, setup)
+    pool = multiprocessing.Pool(n_processes, initializer=initializer, maxtasksperchild=max_tasks_per_process)
+    try:
+        chunk_results = []
+        # collected in submission order, so results stay ordered
+        pending = collections.deque()
+        for chunk in chunks:
+            if len(pending) >= window:
+                chunk_results.append(_chunk_result(pending.popleft()))
+            pending.append(pool.apply_async(chunk_fnc, (chunk,)))
+        while pending:
+            chunk_results.append(_chunk_result(pending.popleft()))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    n_timeouts = sum(isinstance(chunk_result, TaskTimeout) for chunk_result in chunk_results)
+    if n_timeouts:
+        warn("{} chunks timed out, their results are their errors".format(n_timeouts))
+    return unchunk_results(chunk_results, chunk_lengths)
+
+
+def _init_process(n_threads, setup):
+    """ Runs in each pool process, limits the thread pools of numerical libraries then calls setup
+    """
+    os.environ.update(thread_env(n_threads))
+    if setup is not None:
+        setup()
+
+
+def _chunk_result(async_result):
+    """ Returns the result of a chunk, or its error if it timed out
+    """
+    try:
+        return async_result.get()
+    except TaskTimeout as timeout_err:
+        return timeout_err
@@ -0,0 +1,188 @@
+""" This module contains zero-copy serialization of task arguments and results
+
+ipyparallel only sends the data of top-level NumPy arguments as separate ZeroMQ frames;
+arrays nested in containers (e.g. a dict of arrays, or a tuple returned by a task)
+are copied into the pickle stream, and copied again when unpickled.
+Wrapping an object in OOBPayload pickles it with protocol 5 instead, so that the data of
+every buffer-aware object in it (NumPy arrays, bytearrays, ...) is sent as a raw frame
+without intermediate copies, however deeply it is nested.
+
+Arrays received this way may be read-only, copy them before modifying them in place.
+
+Buffers can optionally be compressed, which pays off on slow networks for compressible
+data such as masks or smooth float arrays. Compression uses a codec from CODECS;
+blosc and lz4 are only available if installed.
+
+Importing this module imports ipyparallel.
+"""
+
+import functools
+import pickle
+
+from ipyparallel.serialize import canning
+
+CODECS = ('zlib', 'bz2', 'lzma', 'blosc', 'lz4')
+
+# compressed buffers must be at most this fraction of their original size to be sent compressed
+MAX_COMPRESSION_RATIO = 0.9
+
+
+class OOBPayload(object):
+    """ Wraps an object to be sent with pickle protocol 5 out-of-band buffers
+
+    The wrapper only exists in transit: the receiving side gets the wrapped object itself.
+
+    Args:
+      obj: the object to send
+      compress: (optional) name of the codec in CODECS to compress buffers with
+      compress_threshold: (optional) buffers smaller than this many bytes aren't compressed
+    """
+
+    def __init__(self, obj, compress=None, compress_threshold=2 ** 16):
+        if compress is not None and compress not in CODECS:
+            raise ValueError("Unknown codec {}, expected one of {}".format(compress, CODECS))
+        self.obj = obj
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+
+
+class CannedOOB(canning.CannedObject):
+    """ Canned OOBPayload, ipyparallel sends each of self.buffers as its own frame
+    """
+
+    def __init__(self, payload):
+        self.keys = []
+        self.hook = None
+        self.buffers = []
+        self.codecs = []
+        self.compress = payload.compress
+        self.compress_threshold = payload.compress_threshold
+        self.obj = pickle.dumps(payload.obj, protocol=5, buffer_callback=self._add_buffer)
+        self.obj_codec = None
+        if self.compress is not None and len(self.obj) >= self.compress_threshold:
+            self.obj, self.obj_codec = _maybe_compress(self.obj, self.compress)
+
+    def _add_buffer(self, pickle_buffer):
+        try:
+            buf = pickle_buffer.raw()
+        except BufferError:
+            # not contiguous, serialize in-band
+            return True
+        codec = None
+        if self.compress is not None and buf.nbytes >= self.compress_threshold:
+            buf, codec = _maybe_compress(buf, self.compress, memoryview(pickle_buffer).itemsize)
+        self.buffers.append(buf)
+        self.codecs.append(codec)
+
+    def get_object(self, g=None):
+        buffers = [decompress(buf, codec) if codec is not None else buf
+                   for buf, codec in zip(self.buffers, self.codecs)]
+        data = decompress(self.obj, self.obj_codec) if self.obj_codec is not None else self.obj
+        return pickle.loads(data, buffers=buffers)
+
+
+def compress(data, codec, itemsize=1):
+    """ Compress a bytes-like object with codec
+
+    Args:
+      data: bytes-like object
+      codec: name of a codec in CODECS
+      itemsize: size of the items in data, lets blosc shuffle bytes by significance
+
+    Returns:
+      compressed: bytes
+    """
+    if codec == 'zlib':
+        import zlib
+        return zlib.compress(data, 1)
+    if codec == 'bz2':
+        import bz2
+        return bz2.compress(data, 1)
+    if codec == 'lzma':
+        import lzma
+        return lzma.compress(data, preset=1)
+    if codec == 'blosc':
+        import blosc
+        return blosc.compress(data, typesize=itemsize, cname='lz4', shuffle=blosc.SHUFFLE)
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data)
+    raise ValueError("Unknown codec {}, expected one of {}".format(codec, CODECS))
+
+
+def decompress(data, codec):
+    """ Invert compress
+    """
+    if codec == 'zlib':
+        import zlib
+        return zlib.decompress(data)
+    if codec == 'bz2':
+        import bz2
+        return bz2.decompress(data)
+    if codec == 'lzma':
+        import lzma
+        return lzma.decompress(data)
+    if codec == 'blosc':
+        import blosc
+        return blosc.decompress(data)
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    raise ValueError("Unknown codec {}, expected one of {}".format(codec, CODECS))
+
+
+def _maybe_compress(data, codec, itemsize=1):
+    """ Compress data, unless that doesn't make it meaningfully smaller
+
+    Returns:
+      data: the compressed data, or data itself
+      codec: codec used, None if data wasn't compressed
+    """
+    if codec == 'blosc' and len(data) >= 2 ** 31:
+        # larger than blosc can handle in one go
+        return data, None
+    compressed = compress(data, codec, itemsize)
+    if len(compressed) > MAX_COMPRESSION_RATIO * len(data):
+        return data, None
+    return compressed, codec
+
+
+def register_canning():
+    """ Teach ipyparallel to can OOBPayload, in this process
+
+    Must be called in every process that sends an OOBPayload, i.e. the client for
+    arguments and the engines for results. Unwrapping needs no registration.
+    """
+    if pickle.HIGHEST_PROTOCOL < 5:
+        raise RuntimeError("Out-of-band serialization requires pickle protocol 5 (Python 3.8+)")
+    canning.can_map[OOBPayload] = CannedOOB
+
+
+def oob_args(iterable, compress=None, compress_threshold=2 ** 16):
+    """ Wrap each argument in iterable in an OOBPayload
+    """
+    register_canning()
+    for arg in iterable:
+        yield OOBPayload(arg, compress, compress_threshold)
+
+
+def oob_results(fnc, compress=None, compress_threshold=2 ** 16):
+    """ Wrap fnc so that its result is returned in an OOBPayload
+
+    Returns:
+      wrapped: callable to run on the engines in place of fnc
+    """
+    return functools.partial(_call_oob, fnc, compress, compress_threshold)
+
+
+def wrap_result(result, compress=None, compress_threshold=2 ** 16):
+    """ Runs on an engine, wraps result in an OOBPayload to be sent back to the client
+    """
+    register_canning()
+    return OOBPayload(result, compress, compress_threshold)
+
+
+def _call_oob(fnc, compress, compress_threshold, *args, **kwargs):
+    """ Runs on an engine, returns the result of fnc wrapped in an OOBPayload
+    """
+    return wrap_result(fnc(*args, **kwargs), compress, compress_threshold)
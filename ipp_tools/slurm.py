@@ -1,43 +1,187 @@
 """ This module contains slurm related utilities
 """
 
+import itertools
+import signal
 import subprocess
 import socket
 import time
 import os
 
-from ipyparallel import Client
 from warnings import warn
 
-from ipp_tools.utils import profile_installed, install_profile, package_path
+from ipp_tools import engine_cache, startup
+from ipp_tools.log_tools import setup_logging, forward_engine_logs
+from ipp_tools.dispatch import windowed_map, chunk_tasks, unchunk_results, RECYCLE_EXIT_CODE
+from ipp_tools.utils import profile_installed, install_profile, package_path, available_cpus, thread_env
 
 
 PROFILE_NAME = 'profile_slurm'
 
+# directory of the aggregated log of each map
+MAP_LOG_DIR = '~/logs/slurm'
+
+# seconds to wait for local engines to register
+LOCAL_ENGINE_STARTUP_SECONDS = 5
+
+# marks the end of iterables after the pilot run
+_EXHAUSTED = object()
+
 def slurm_map(fnc, iterables, resource_spec,
               env='root', job_name=None, output_path=None,
-              n_retries=5, patience=30):
+              n_retries=5, patience=30, zero_copy=False, compress=None, compress_threshold=2 ** 16,
+              max_in_flight=None, setup=None, speculative_factor=None, speculative_budget=0.01,
+              chunksize=1, pilot=None, n_pilot_tasks=8, target_seconds=3600, n_tasks=None,
+              backend='slurm', n_local_engines=0, task_timeout=None, timeout_retries=1,
+              retry_policy=None, max_replacements=None, max_tasks_per_engine=None, max_engine_rss_mb=None,
+              memory_limit_fraction=0.9, pin_cpus=False, packed_env=None, scratch_dir='/tmp', forward_logs=True,
+              engine_wait_timeout=3600):
     """
 
     Args:
       fnc
-      iterables
+      iterables: arguments to map fnc over. Consumed lazily, so it may be a generator
       resource_spec
-      env: virtual env to launch engines in
+      env: virtual env to launch engines in. ipp_tools must be installed in it along with
+        ipyparallel, engines import it for setup, timeouts, memory limits, log forwarding and
+        startup timing. Without it, engines start as plain ipengines, without startup timing
       job_name: name of job to use. Derived from fnc name if not specified
       output_path: location to direct output to.
         If unspecified output is sent to a file (based on job name and timestamp) in ~/logs/slurm
       n_retries: number of times to retry connecting to client if less than the requested number
         of workers are available.
       patience: seconds to wait after failed attempt to connect to client
+      zero_copy: if True, arguments and results are sent with pickle protocol 5 out-of-band
+        buffers, so NumPy data is never copied on its way through pickle, even when nested
+        in containers. Received arrays may be read-only. See ipp_tools.serialization
+      compress: name of a codec in ipp_tools.serialization.CODECS to compress arguments and
+        results with, implies zero_copy. Only worth it on slow networks and for compressible
+        data, see benchmarks/bench_serialization.py
+      compress_threshold: buffers smaller than this many bytes aren't compressed
+      max_in_flight: maximum number of tasks submitted at once, new tasks are submitted as
+        results come back. Defaults to twice the number of engines
+      setup: callable run once on each engine as soon as it registers, before it gets any tasks.
+        Use it for heavy one-time setup, e.g. importing torch or loading a model into globals.
+        fnc itself is also sent only once per engine
+      speculative_factor: once no task is waiting for an engine, tasks running this many times
+        longer than the median task are duplicated on idle engines and the first result wins.
+        Only for tasks that can safely run twice. None disables speculative execution
+      speculative_budget: fraction of the tasks that may be duplicated, at least one
+      chunksize: number of elements of iterables sent to an engine as one task. Larger chunks
+        amortize the per-task overhead when tasks are short
+      pilot: if 'recommend' or 'apply', first run n_pilot_tasks tasks locally, each in a fresh
+        process, and derive max_workers, worker_mem_mb and chunksize from their runtime and
+        memory so that the remaining tasks finish in target_seconds. 'recommend' only prints
+        the recommendation, 'apply' uses it instead of resource_spec and chunksize.
+        Pilot tasks aren't run again, their results are part of the returned results
+      n_pilot_tasks: number of tasks in the pilot run
+      target_seconds: wall-clock time the pilot run sizes the map for
+      n_tasks: number of elements in iterables, needed by the pilot run if iterables has no len
+      backend: 'slurm' runs the tasks on SLURM engines, 'local' on a process pool on this node,
+        with the same result ordering. fnc and setup must then be picklable without cloudpickle.
+        'auto' runs n_pilot_tasks tasks locally to estimate whether the cluster's startup time
+        is worth paying, and picks 'slurm' without a pilot run if the number of tasks is unknown
+        or tasks need GPUs
+      n_local_engines: number of engines to start on this node next to the SLURM engines.
+        Tasks start as soon as one engine is up instead of waiting for min_workers SLURM
+        engines, which join as they are allocated
+      task_timeout: seconds a task (a chunk if chunksize > 1) may run for before it's interrupted.
+        Timed out tasks are retried on other engines up to timeout_retries times, then
+        recorded as failed, with the error as their result. None disables timeouts
+      retry_policy: dict with the max_attempts, backoff_seconds, backoff_factor, retry_on
+        (exact names of retryable errors) and retry_lost fields, see dispatch.process_retry_policy.
+        By default tasks lost with their engine (e.g. a preempted node) are retried on
+        surviving engines, twice at most, and errors in tasks are raised
+      max_replacements: for each engine lost while tasks are running, one more SLURM engine is
+        requested, up to this many. Defaults to max_workers
+      max_tasks_per_engine: restart engines after this many tasks (chunks if chunksize > 1),
+        like maxtasksperchild, to contain libraries that leak memory. Engines are drained first,
+        so no work is lost. On the local backend, worker processes are restarted instead
+      max_engine_rss_mb: restart engines whose resident memory exceeds this after a task
+      memory_limit_fraction: tasks may allocate this fraction of worker_mem_mb on top of the memory
+        of their engine, so that a task needing too much memory fails with a MemoryError, recorded
+        as its result, before SLURM kills its engine. Not applied on GPU engines, whose drivers map large amounts
+        of memory. None disables the limit
+      pin_cpus: if True, bind each engine to its own cores, with srun --cpu-bind=cores for SLURM
+        engines. Engines always limit the thread pools of OpenMP, MKL, OpenBLAS and numexpr to
+        worker_n_cpus threads (local engines and processes to their share of this node's CPUs)
+      packed_env: path to an archive of env made with conda-pack, on a filesystem shared with the
+        nodes. The first engine on each node unpacks it to scratch_dir, and engines run from there
+        instead of importing from the shared filesystem. Engines fall back to env if unpacking fails
+      scratch_dir: node-local directory packed_env is unpacked to
+      forward_logs: if True, the log records of every engine are forwarded to the driver and
+        written, ordered by time, to one log per map: {MAP_LOG_DIR}/{job_name}_{timestamp}.log
+      engine_wait_timeout: seconds to wait for a new engine once every engine is lost, e.g. for
+        replacements queued in SLURM, before raising TimeoutError
 
     """
     resource_spec = process_resource_spec(resource_spec)
 
+    if pilot not in (None, 'recommend', 'apply'):
+        raise ValueError("pilot must be None, 'recommend' or 'apply', got {}".format(pilot))
+    if backend not in ('auto', 'local', 'slurm'):
+        raise ValueError("backend must be 'auto', 'local' or 'slurm', got {}".format(backend))
+
+    if n_tasks is None and hasattr(iterables, '__len__'):
+        n_tasks = len(iterables)
+    if backend == 'auto' and n_tasks is None:
+        print("Number of tasks unknown, using the slurm backend")
+        backend = 'slurm'
+    if backend == 'auto' and resource_spec['worker_n_gpus'] > 0:
+        print("Tasks need GPUs, using the slurm backend")
+        backend = 'slurm'
+
+    pilot_results = []
+    n_local_processes = None
+    if pilot is not None or backend == 'auto':
+        from ipp_tools.pilot import pilot_run, recommend_resources, choose_backend
+
+        if n_tasks is None:
+            raise ValueError("A pilot run needs n_tasks if iterables has no len")
+        if n_pilot_tasks < 1:
+            raise ValueError("A pilot run needs n_pilot_tasks >= 1, got {}".format(n_pilot_tasks))
+        iterables = iter(iterables)
+        pilot_args = list(itertools.islice(iterables, n_pilot_tasks))
+        if not pilot_args:
+            print("No tasks to run")
+            return []
+        pilot_results, pilot_stats = pilot_run(fnc, pilot_args, setup=setup)
+
+        next_arg = next(iterables, _EXHAUSTED)
+        if next_arg is _EXHAUSTED:
+            print("Pilot run finished every task")
+            return pilot_results
+        iterables = itertools.chain([next_arg], iterables)
+
+        n_remaining = max(n_tasks - len(pilot_args), 1)
+        if pilot is not None:
+            recommended_spec, recommended_chunksize = recommend_resources(
+                pilot_stats, n_remaining, target_seconds, resource_spec)
+            if pilot == 'apply':
+                resource_spec, chunksize = recommended_spec, recommended_chunksize
+        if backend == 'auto':
+            # the controller gets 10 seconds to start, engines patience seconds
+            backend, n_local_processes = choose_backend(pilot_stats, n_remaining, resource_spec,
+                                                        startup_seconds=10 + patience)
+            print("Using the {} backend".format(backend))
+
+    if backend == 'local':
+        from ipp_tools.pool import pool_map
+
+        result = pool_map(fnc, iterables, n_processes=n_local_processes, setup=setup,
+                          chunksize=chunksize, max_in_flight=max_in_flight, task_timeout=task_timeout,
+                          max_tasks_per_process=max_tasks_per_engine)
+        return pilot_results + result
+
     if not profile_installed(PROFILE_NAME):
         print("No profile found for {}, installing".format(PROFILE_NAME))
         install_profile(PROFILE_NAME)
 
+    if job_name is None:
+        job_name = fnc.__name__ + '_slurm_map'
+    else:
+        assert isinstance(job_name, str)
+
     submission_time = time.strftime("%Y%m%d-%H%M%S")
     cluster_id = '{}_{}'.format(fnc.__name__, submission_time)
     print("Using cluster id: {}".format(cluster_id))
@@ -54,125 +198,285 @@ def slurm_map(fnc, iterables, resource_spec,
     )
 
     print("Starting controller with: {} \n".format(controller_cmd))
-    # runs in the background if executed this way
-    subprocess.Popen(controller_cmd, shell=True)
-
-    print("Sleeping for 10")
-    time.sleep(10)
-
-    engine_cmd_template_path = package_path() + '/templates/slurm_template.sh'
-    with open(engine_cmd_template_path,  'r') as engine_cmd_template_file:
-        engine_command_template = engine_cmd_template_file.read()
-
-
-    # prepare engine commands
-    if job_name is None:
-        job_name = fnc.__name__ + '_slurm_map'
-    else:
-        assert isinstance(job_name, str)
-
-    if output_path is None:
-        output_dir = os.path.expanduser('~/logs/slurm')
-        output_path = '{}/{}_{}'.format (output_dir, job_name, submission_time)
-
-        if not os.path.exists(output_dir):
-            os.makedirs(output_path)
-    else:
-        assert isinstance(output_path, str)
-        assert os.path.exists(output_path)
-
-    # find path to engine based on specified environment
-    if env == 'root':
-        engine_path = 'bin/ipengine'
-    else:
-        engine_path = 'envs/{}/bin/ipengine'.format(env)
-
-    full_engine_path = os.path.expanduser('~/anaconda3/{}'.format(engine_path))
-    assert os.path.exists(full_engine_path)
-
-
-
-    engine_command = engine_command_template.format(
-        job_name=job_name,
-        output_path=output_path,
-        n_tasks=resource_spec['max_workers'],
-        mem_mb=resource_spec['worker_mem_mb'],
-        n_cpus=resource_spec['worker_n_cpus'],
-        n_gpus=resource_spec['worker_n_gpus'],
-        engine_path=engine_path,
-        profile=PROFILE_NAME,
-        controller_hostname=socket.gethostname(),
-        cluster_id=cluster_id,
-        comment=job_name
-    )
-
-    sbatch_file_path = '/tmp/slurm_map_sbatch_{}.sh'.format(cluster_id)
-    with open(sbatch_file_path, 'w') as sbatch_file:
-        sbatch_file.write(engine_command)
-
-    # wrap command to execute in bash
-    sbatch_command = "exec bash -c 'sbatch {}'".format(sbatch_file_path)
-
-    print("Starting engines")
-    # runs in the background if executed this way
-    subprocess.Popen(sbatch_command, shell=True)
-    print("Sleeping for {}".format(patience))
-    time.sleep(patience)
-
-    # TODO: shut down unused engines
-    connected = False
-    for attempt_idx in range(n_retries):
-        print("Attempt {} to connect to cluster".format(attempt_idx))
-        try:
-            client = Client(profile=PROFILE_NAME, cluster_id=cluster_id)
-            if resource_spec['min_workers'] <= len(client.ids) <= resource_spec['max_workers']:
-                connected = True
-                print('Succesfully connected to cluster with {} engines out of {} requested'.format(
-                    len(client.ids), resource_spec['max_workers']))
-
-                if len(client.ids) < resource_spec['max_workers']:
-                    warn("{} slurm jobs submitted but only {} are being used.".format(
-                        resource_spec['max_workers'], len(client.ids)))
-
-                break
-            else:
-                print("{} available engines less than minimum requested of {}".format(
-                    len(client.ids), resource_spec['min_workers']))
+    # runs in the background if executed this way, in its own process group so it can be killed
+    # if slurm_map fails before a client can shut it down
+    controller = subprocess.Popen(controller_cmd, shell=True, start_new_session=True)
+
+    client = None
+    local_engines = []
+    log_forwarding = None
+    sbatch_file_path = None
+    # everything started from here on is shut down however slurm_map exits, e.g. on a failed
+    # task or a KeyboardInterrupt
+    try:
+        print("Sleeping for 10")
+        time.sleep(10)
+
+        engine_cmd_template_path = os.path.join(package_path(), 'templates', 'slurm_template.sh')
+        with open(engine_cmd_template_path,  'r') as engine_cmd_template_file:
+            engine_command_template = engine_cmd_template_file.read()
+
+
+        # prepare engine commands
+        if output_path is None:
+            output_dir = os.path.expanduser('~/logs/slurm')
+            output_path = '{}/{}_{}'.format (output_dir, job_name, submission_time)
+
+            if not os.path.exists(output_dir):
+                os.makedirs(output_path)
+        else:
+            assert isinstance(output_path, str)
+            assert os.path.exists(output_path)
+
+        # find path to engine based on specified environment
+        if env == 'root':
+            engine_path = 'bin/ipengine'
+        else:
+            engine_path = 'envs/{}/bin/ipengine'.format(env)
+
+        full_engine_path = os.path.expanduser('~/anaconda3/{}'.format(engine_path))
+        assert os.path.exists(full_engine_path)
+
+        stage_env = ''
+        if packed_env is not None:
+            packed_env = os.path.abspath(os.path.expanduser(packed_env))
+            assert os.path.exists(packed_env)
+            stage_env_template_path = os.path.join(package_path(), 'templates', 'stage_env_template.sh')
+            with open(stage_env_template_path, 'r') as stage_env_template_file:
+                stage_env_template = stage_env_template_file.read()
+            # a new archive is unpacked next to the old one rather than over it
+            env_key = '{}_{}'.format(os.path.basename(packed_env).split('.')[0], int(os.path.getmtime(packed_env)))
+            stage_env = stage_env_template.format(scratch_dir=scratch_dir, env_key=env_key, packed_env=packed_env)
+
+
+
+        engine_command = engine_command_template.format(
+            job_name=job_name,
+            output_path=output_path,
+            n_tasks=resource_spec['max_workers'],
+            mem_mb=resource_spec['worker_mem_mb'],
+            n_cpus=resource_spec['worker_n_cpus'],
+            n_gpus=resource_spec['worker_n_gpus'],
+            engine_bin=os.path.dirname(engine_path),
+            profile=PROFILE_NAME,
+            controller_hostname=socket.gethostname(),
+            cluster_id=cluster_id,
+            comment=job_name,
+            recycle_exit_code=RECYCLE_EXIT_CODE,
+            thread_exports='\n'.join('export {}={}'.format(name, value) for name, value
+                                      in sorted(thread_env(resource_spec['worker_n_cpus']).items())),
+            srun_options='--cpu-bind=cores ' if pin_cpus else '',
+            stage_env=stage_env,
+            startup_command=startup.STARTUP_COMMAND
+        )
+
+        sbatch_file_path = '/tmp/slurm_map_sbatch_{}.sh'.format(cluster_id)
+        with open(sbatch_file_path, 'w') as sbatch_file:
+            sbatch_file.write(engine_command)
+
+        # wrap command to execute in bash
+        sbatch_command = "exec bash -c 'sbatch {}'".format(sbatch_file_path)
+
+        print("Starting engines")
+        # runs in the background if executed this way
+        subprocess.Popen(sbatch_command, shell=True)
+
+        local_engines = []
+        if n_local_engines:
+            # split this node's CPUs between the local engines
+            n_engine_cpus = max(1, min(resource_spec['worker_n_cpus'], available_cpus() // n_local_engines))
+            # CPUs can only be bound on Linux
+            local_cpus = sorted(os.sched_getaffinity(0)) if pin_cpus and hasattr(os, 'sched_getaffinity') else []
+            for engine_idx in range(n_local_engines):
+                engine_cpus = None
+                if (engine_idx + 1) * n_engine_cpus <= len(local_cpus):
+                    engine_cpus = local_cpus[engine_idx * n_engine_cpus:(engine_idx + 1) * n_engine_cpus]
+                local_engines.append(_start_local_engine(full_engine_path, cluster_id, n_engine_cpus, engine_cpus))
+        if local_engines:
+            # SLURM engines join the running map as they are allocated
+            min_engines = 1
+            patience = min(patience, LOCAL_ENGINE_STARTUP_SECONDS)
+        else:
+            min_engines = resource_spec['min_workers']
+        max_engines = resource_spec['max_workers'] + n_local_engines
+
+        print("Sleeping for {}".format(patience))
+        time.sleep(patience)
+
+        from ipyparallel import Client
+
+        # TODO: shut down unused engines
+        connected = False
+        for attempt_idx in range(n_retries):
+            print("Attempt {} to connect to cluster".format(attempt_idx))
+            try:
+                client = Client(profile=PROFILE_NAME, cluster_id=cluster_id)
+                if min_engines <= len(client.ids) <= max_engines:
+                    connected = True
+                    print('Succesfully connected to cluster with {} engines out of {} requested'.format(
+                        len(client.ids), max_engines))
+
+                    if len(client.ids) < max_engines and not local_engines:
+                        warn("{} slurm jobs submitted but only {} are being used.".format(
+                            resource_spec['max_workers'], len(client.ids)))
+
+                    break
+                else:
+                    print("{} available engines less than minimum requested of {}".format(
+                        len(client.ids), min_engines))
+                    print("Retrying after {}".format(patience))
+                    client.close()
+                    time.sleep(patience)
+            except OSError as os_err:
+                print("Caught OSError while attempting to connect to {}: {}.".format(PROFILE_NAME, os_err))
                 print("Retrying after {}".format(patience))
-                client.close()
                 time.sleep(patience)
-        except OSError as os_err:
-            print("Caught OSError while attempting to connect to {}: {}.".format(PROFILE_NAME, os_err))
-            print("Retrying after {}".format(patience))
-            time.sleep(patience)
-        except TimeoutError as timeout_err:
-            print("Caught TimeoutError while attempting to connect to {}: {}".format(PROFILE_NAME, timeout_err))
-            print("Retrying after {}".format(patience))
-            time.sleep(patience)
-
-    if not connected:
-        raise TimeoutError("Failed to connect to client after {} retries".format(n_retries))
-
-    # run tasks
-    print("Submitting tasks")
-    start_time = time.time()
-    client[:].use_cloudpickle()
-    lb_view = client.load_balanced_view()
-    result = lb_view.map(fnc, iterables, block=True)
-    print("Tasks finished after {} seconds".format(time.time() - start_time))
+            except TimeoutError as timeout_err:
+                print("Caught TimeoutError while attempting to connect to {}: {}".format(PROFILE_NAME, timeout_err))
+                print("Retrying after {}".format(patience))
+                time.sleep(patience)
+
+        if not connected:
+            raise TimeoutError("Failed to connect to client after {} retries".format(n_retries))
+
+        if max_replacements is None:
+            max_replacements = resource_spec['max_workers']
+        replacements = []
+
+        def replace_engine(engine_id):
+            if len(replacements) >= max_replacements:
+                print("Lost engine {}, but already requested {} replacements".format(engine_id, len(replacements)))
+                return
+            replacements.append(engine_id)
+            print("Requesting a replacement for engine {}".format(engine_id))
+            # a new array with a single element, named like the others so scancel catches it
+            replacement_command = "exec bash -c 'sbatch --array=1 {}'".format(sbatch_file_path)
+            subprocess.Popen(replacement_command, shell=True)
+
+        task_memory_mb = None
+        if memory_limit_fraction is not None:
+            if resource_spec['worker_n_gpus'] > 0:
+                print("Not limiting the memory of tasks on GPU engines")
+            else:
+                task_memory_mb = memory_limit_fraction * resource_spec['worker_mem_mb']
+
+        if forward_logs:
+            logger = setup_logging('{}_{}.log'.format(job_name, submission_time), MAP_LOG_DIR)
+            # engines start forwarding as they're set up, including engines that join later
+            log_forwarding = forward_engine_logs(client, logger, engine_ids=[])
+            engine_ready_callback = lambda engine_id: log_forwarding.add_engines([engine_id], block=False)
+        else:
+            engine_ready_callback = None
+
+        # run tasks
+        print("Submitting tasks")
+        start_time = time.time()
+        if chunksize > 1:
+            fnc, iterables, chunk_lengths = chunk_tasks(fnc, iterables, chunksize)
+        if zero_copy or compress is not None:
+            from ipp_tools.serialization import oob_args, oob_results
+            fnc = oob_results(fnc, compress, compress_threshold)
+            iterables = oob_args(iterables, compress, compress_threshold)
+        result = windowed_map(client, fnc, iterables, max_in_flight, setup=setup, use_cloudpickle=True,
+                              speculative_factor=speculative_factor, speculative_budget=speculative_budget,
+                              task_timeout=task_timeout, timeout_retries=timeout_retries,
+                              retry_policy=retry_policy, engine_lost_callback=replace_engine,
+                              engine_ready_callback=engine_ready_callback,
+                              max_tasks_per_engine=max_tasks_per_engine, max_engine_rss_mb=max_engine_rss_mb,
+                              task_memory_mb=task_memory_mb, engine_wait_timeout=engine_wait_timeout)
+        if chunksize > 1:
+            result = unchunk_results(result, chunk_lengths)
+        result = pilot_results + result
+        print("Tasks finished after {} seconds".format(time.time() - start_time))
+        engine_cache.report_stats(client)
+        startup.report_startup(client)
+
+        return result
+    finally:
+        _shut_down_cluster(controller, client, local_engines, log_forwarding, job_name, sbatch_file_path)
+
+
+def _shut_down_cluster(controller, client, local_engines, log_forwarding, job_name, sbatch_file_path):
+    """ Shut down everything slurm_map started, whatever it got to before exiting
 
+    Args:
+      controller: Popen of the shell running the controller
+      client: (optional) ipyparallel Client connected to the cluster, None if it never connected
+      local_engines: Popens of the shells running local engines
+      log_forwarding: (optional) EngineLogForwarding of the map
+      job_name: name of the SLURM jobs running engines
+      sbatch_file_path: (optional) path to the sbatch script, None if it wasn't written
+    """
+    try:
+        if log_forwarding is not None:
+            log_forwarding.stop()
+    except Exception as stop_err:
+        print("Failed to stop forwarding engine logs: {}".format(stop_err))
+    finally:
+        # also runs if the user interrupts stopping the log forwarding
+        _stop_cluster(controller, client, local_engines, job_name, sbatch_file_path)
+
+
+def _stop_cluster(controller, client, local_engines, job_name, sbatch_file_path):
+    """ Shut down the controller and the engines, see _shut_down_cluster
+    """
     print("Shutting down cluster")
-    client.shutdown(hub=True)
-    print("Relinquishing slurm nodes")
-    shutdown_cmd =  'scancel -n={job_name}'.format(job_name=job_name)
-    shutdown_cmd = "exec bash -c '{}'".format(shutdown_cmd)
-    # runs in the background if executed this way
-    subprocess.Popen(shutdown_cmd, shell=True)
+    controller_stopped = False
+    if client is not None:
+        try:
+            client.shutdown(hub=True)
+            controller_stopped = True
+        except Exception as shutdown_err:
+            print("Failed to shut down the cluster: {}".format(shutdown_err))
+        client.close()
+    if not controller_stopped and controller.poll() is None:
+        os.killpg(controller.pid, signal.SIGTERM)
+    for local_engine in local_engines:
+        if local_engine.poll() is None:
+            # the engine and the loop restarting it
+            os.killpg(local_engine.pid, signal.SIGTERM)
+
+    if sbatch_file_path is not None:
+        print("Relinquishing slurm nodes")
+        shutdown_cmd =  'scancel -n={job_name}'.format(job_name=job_name)
+        shutdown_cmd = "exec bash -c '{}'".format(shutdown_cmd)
+        # runs in the background if executed this way
+        subprocess.Popen(shutdown_cmd, shell=True)
+
+        print("Removing sbatch script")
+        if os.path.exists(sbatch_file_path):
+            os.remove(sbatch_file_path)
+
+
+def _start_local_engine(full_engine_path, cluster_id, n_threads, cpus=None):
+    """ Starts an engine of the cluster on this node
+
+    Like the sbatch script, starts a fresh engine whenever the engine is recycled
 
-    print("Removing sbatch script")
-    os.remove(sbatch_file_path)
+    Args:
+      full_engine_path: path to ipengine
+      cluster_id: id of the cluster
+      n_threads: size of the thread pools of numerical libraries in the engine
+      cpus: (optional) CPUs to bind the engine to
 
-    return result
+    Returns:
+      process: Popen of the shell running the engine, leader of its own process group
+    """
+    python_path = os.path.join(os.path.dirname(full_engine_path), 'python')
+    if subprocess.call([python_path, '-c', 'import ipp_tools.launch_engine'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+        engine_cmd = '{} -m ipp_tools.launch_engine --profile={} --cluster-id={} --IPEngine.startup_command="{}"'.format(
+            python_path, PROFILE_NAME, cluster_id, startup.STARTUP_COMMAND)
+    else:
+        # like the sbatch script, fall back to a plain engine without startup timing
+        print("ipp_tools can't be imported by {}".format(python_path))
+        engine_cmd = '{} --profile={} --cluster-id={}'.format(full_engine_path, PROFILE_NAME, cluster_id)
+    print("Starting local engine with: {}".format(engine_cmd))
+    loop_cmd = 'while true; do export {}=$(date +%s.%N); {}; [ $? -eq {} ] || break; done'.format(
+        startup.LAUNCH_TIME_VAR, engine_cmd, RECYCLE_EXIT_CODE)
+    env = dict(os.environ, **thread_env(n_threads))
+    preexec_fn = None if cpus is None else lambda: os.sched_setaffinity(0, cpus)
+    return subprocess.Popen(['bash', '-c', loop_cmd], env=env, preexec_fn=preexec_fn, start_new_session=True)
 
 
 def process_resource_spec(resource_spec):
@@ -0,0 +1,161 @@
+""" This module contains engine startup timing
+
+Engines launched by slurm_map record when each phase of their startup finishes:
+
+  staging: unpacking the environment to node-local scratch, if it's staged (once per node)
+  environment: from the launch of the engine to the start of its interpreter (srun, activation)
+  imports: importing ipyparallel and its dependencies
+  connection_file: loading config, then finding and reading the controller's connection file
+  registration: the registration handshake with the controller
+
+The launch scripts export the times they launch each engine and stage its environment,
+ipp_tools.launch_engine records the end of the imports and of the connection file lookup,
+and engines mark their registration by running STARTUP_COMMAND. report_startup summarizes
+the phases over all engines and per host. All the times of an engine are taken on its node,
+so clocks of different nodes don't need to agree.
+"""
+
+import os
+import socket
+import time
+
+from ipp_tools.utils import gather_engine_reports
+
+# environment variables set by the launch scripts, as seconds since the epoch
+LAUNCH_TIME_VAR = 'IPP_TOOLS_LAUNCH_TIME'
+STAGE_START_VAR = 'IPP_TOOLS_STAGE_START'
+STAGE_END_VAR = 'IPP_TOOLS_STAGE_END'
+
+# run by engines once they're registered, passed to ipengine as IPEngine.startup_command
+STARTUP_COMMAND = 'import ipp_tools.startup; ipp_tools.startup.mark_registered()'
+
+# startup phases, in order, with the events they start and end at
+PHASES = [
+    ('staging', 'stage_start', 'stage_end'),
+    ('environment', 'launch', 'process_start'),
+    ('imports', 'process_start', 'imported'),
+    ('connection_file', 'imported', 'connection_file'),
+    ('registration', 'connection_file', 'registered'),
+]
+
+# number of slowest engines report_startup lists
+N_SLOWEST = 5
+
+_TIMES = {}
+
+
+def mark(event):
+    """ Records the time of a startup event in this engine
+    """
+    _TIMES[event] = time.time()
+
+
+def mark_registered():
+    """ Runs on an engine right after it registers, records the time
+    """
+    mark('registered')
+
+
+def engine_startup():
+    """ Runs on an engine, returns how long it took to start
+
+    Returns:
+      startup: dict of the host and pid of this engine, the seconds spent in each of PHASES
+        and startup_seconds from launch to registration, None where unknown
+    """
+    times = {
+        'launch': _env_time(LAUNCH_TIME_VAR),
+        'stage_start': _env_time(STAGE_START_VAR),
+        'stage_end': _env_time(STAGE_END_VAR),
+        'process_start': _process_start_time(),
+    }
+    times.update(_TIMES)
+    startup = {
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'startup_seconds': _seconds_between(times, 'launch', 'registered'),
+    }
+    for phase, start_event, end_event in PHASES:
+        startup[phase] = _seconds_between(times, start_event, end_event)
+    return startup
+
+
+def report_startup(client, timeout=10):
+    """ Prints the p50 and p95 of each startup phase of the engines of client, overall and per host
+
+    Args:
+      client: ipyparallel Client connected to the cluster
+      timeout: seconds to wait for engines to report
+
+    Returns:
+      engine_startups: dict of engine id to startup, for engines that reported
+    """
+    engine_startups = gather_engine_reports(client, engine_startup, 'its startup time', timeout=timeout)
+    startups = list(engine_startups.values())
+    if not any(startup['startup_seconds'] is not None for startup in startups):
+        return engine_startups
+
+    hosts = sorted(set(startup['host'] for startup in startups))
+    print("Engine startup over {} engines on {} hosts, seconds (p50 / p95):".format(len(startups), len(hosts)))
+    print("  {}".format(_phase_summary(startups)))
+    if len(hosts) > 1:
+        for host in hosts:
+            host_startups = [startup for startup in startups if startup['host'] == host]
+            print("  {} ({} engines): {}".format(host, len(host_startups), _phase_summary(host_startups)))
+    slowest = sorted((startup['startup_seconds'], engine_id) for engine_id, startup in engine_startups.items()
+                     if startup['startup_seconds'] is not None)[-N_SLOWEST:]
+    print("  slowest engines: {}".format(', '.join('{} ({}) {:.1f}'.format(
+        engine_id, engine_startups[engine_id]['host'], seconds) for seconds, engine_id in reversed(slowest))))
+    return engine_startups
+
+
+def _phase_summary(startups):
+    """ Returns a line with the p50 and p95 of each phase and of the total startup time of startups
+    """
+    summaries = []
+    for phase in [phase for phase, _, _ in PHASES] + ['startup_seconds']:
+        seconds = sorted(startup[phase] for startup in startups if startup[phase] is not None)
+        if seconds:
+            summaries.append('{} {:.1f} / {:.1f}'.format(
+                'total' if phase == 'startup_seconds' else phase,
+                _percentile(seconds, 50), _percentile(seconds, 95)))
+    return ', '.join(summaries)
+
+
+def _percentile(sorted_values, percent):
+    """ Returns the nearest-rank percentile of a sorted list
+    """
+    rank = int(round(percent / 100. * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def _seconds_between(times, start_event, end_event):
+    """ Returns the seconds between two events, None if either is unknown
+    """
+    if times.get(start_event) is None or times.get(end_event) is None:
+        return None
+    # the process start time is only accurate to a clock tick
+    return max(0., times[end_event] - times[start_event])
+
+
+def _process_start_time():
+    """ Returns the time this process started, None if it's unknown
+    """
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # the command name may contain spaces, fields are counted from its closing parenthesis
+            start_ticks = int(stat_file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+    return time.time() - (uptime - start_ticks / float(os.sysconf('SC_CLK_TCK')))
+
+
+def _env_time(name):
+    """ Returns the time in environment variable name, None if it's unset or invalid
+    """
+    try:
+        return float(os.environ[name])
+    except (KeyError, ValueError):
+        return None
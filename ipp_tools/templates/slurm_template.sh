@@ -0,0 +1,31 @@
+#!/bin/bash
+#SBATCH --job-name={job_name}
+#SBATCH --output={output_path}
+#SBATCH --ntasks=1
+#SBATCH --array=1-{n_tasks}
+#SBATCH --time=0
+#SBATCH --mem={mem_mb}
+#SBATCH --cpus-per-task={n_cpus}
+#SBATCH --gres=gpu:{n_gpus}
+#SBATCH --comment="{comment}"
+
+# one thread per allocated CPU in numerical libraries, instead of one per core of the node
+{thread_exports}
+
+ENGINE_BIN=~/anaconda3/{engine_bin}
+{stage_env}
+# engines are launched through ipp_tools to time their startup, or as plain ipengines if the
+# environment doesn't have ipp_tools
+if $ENGINE_BIN/python -c 'import ipp_tools.launch_engine' > /dev/null 2>&1; then
+    ENGINE_CMD=($ENGINE_BIN/python -m ipp_tools.launch_engine --IPEngine.startup_command="{startup_command}")
+else
+    echo "ipp_tools can't be imported in $ENGINE_BIN, starting engines without startup timing"
+    ENGINE_CMD=($ENGINE_BIN/ipengine)
+fi
+
+# engines recycled by slurm_map exit with {recycle_exit_code}, start a fresh one in their place
+while true; do
+    export IPP_TOOLS_LAUNCH_TIME=$(date +%s.%N)
+    srun {srun_options}"${{ENGINE_CMD[@]}}" --profile={profile} --location={controller_hostname} --cluster-id={cluster_id}
+    [ $? -eq {recycle_exit_code} ] || break
+done
@@ -0,0 +1,15 @@
+# unpack the environment to node-local scratch once per node, the engines on a node share it
+export IPP_TOOLS_STAGE_START=$(date +%s.%N)
+ENV_DIR={scratch_dir}/ipp_tools_env_{env_key}
+(
+    flock 9
+    if [ ! -f $ENV_DIR/.unpacked ]; then
+        rm -rf $ENV_DIR && mkdir -p $ENV_DIR && tar -xzf {packed_env} -C $ENV_DIR && $ENV_DIR/bin/conda-unpack && touch $ENV_DIR/.unpacked
+    fi
+) 9>$ENV_DIR.lock
+export IPP_TOOLS_STAGE_END=$(date +%s.%N)
+# fall back to the shared environment if unpacking failed
+if [ -f $ENV_DIR/.unpacked ]; then
+    ENGINE_BIN=$ENV_DIR/bin
+    export PATH=$ENV_DIR/bin:$PATH
+fi
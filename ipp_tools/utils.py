@@ -1,25 +1,99 @@
 """ This module contains misc. utils
 """
 
+import json
 import os
-import sys
+import resource
 import shutil
-from ipyparallel import Client
+import socket
+import sys
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from glob import glob
 
+# thread pool sizes of OpenMP, MKL, OpenBLAS, numexpr and Accelerate, which default to one thread per core
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS')
+
+
 def package_path():
-    """ Returns the absolute path to this package base directory
+    """ Returns the absolute path to this package's directory, which holds its templates and profiles
 
-    :returns: absolute path to ipp-tools/
+    :returns: absolute path to ipp_tools/
     :rtype: string
 
     """
-    mjhmc_path = [path for path in sys.path if 'ipp-tools' in path][0]
-    if mjhmc_path is None:
-        raise Exception('You must include ipp-tools in your PYTHON_PATH')
-    prefix = mjhmc_path.split('ipp-tools')[0]
-    return "{}ipp-tools".format(prefix)
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def available_cpus():
+    """ Returns the number of CPUs this process may run on, e.g. its SLURM allocation
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on macOS
+        return os.cpu_count() or 1
+
+
+def thread_env(n_threads):
+    """ Returns the environment variables that size the thread pools of numerical libraries
+
+    Libraries read them once, when they're loaded, so they must be set before e.g. NumPy is imported
+
+    Args:
+      n_threads: number of threads each library may use
+
+    Returns:
+      env: dict of environment variable names to values
+    """
+    return {name: str(n_threads) for name in THREAD_ENV_VARS}
+
+
+def rss_mb(peak=False):
+    """ Returns the resident memory of this process in MB
+
+    Args:
+      peak: (optional) if True, return the peak resident memory of this process instead.
+        The current one falls back to the peak where it's unknown (outside of Linux)
+
+    Returns:
+      rss_mb: resident memory in MB
+    """
+    if not peak:
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * resource.getpagesize() / 2. ** 20
+        except (IOError, ValueError, IndexError):
+            pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / 2. ** 20 if sys.platform == 'darwin' else max_rss / 2. ** 10
+
+
+def gather_engine_reports(client, fnc, description, timeout=10):
+    """ Runs fnc on every engine of client at once and collects what each returns
+
+    Args:
+      client: ipyparallel Client connected to the cluster
+      fnc: function without arguments to run on each engine
+      description: what fnc reports, for the message printed about engines that don't
+      timeout: (optional) seconds to wait for all engines to report
+
+    Returns:
+      engine_reports: dict of engine id to the result of fnc, for engines that reported
+    """
+    pending = {engine_id: client[engine_id].apply_async(fnc) for engine_id in client.ids}
+    deadline = time.time() + timeout
+    engine_reports = {}
+    for engine_id, async_result in pending.items():
+        try:
+            engine_reports[engine_id] = async_result.get(timeout=max(deadline - time.time(), 0))
+        except Exception as err:
+            print("Engine {} did not report {}: {}".format(engine_id, description, err))
+    return engine_reports
 
 
 def find_free_profile(profile):
@@ -36,9 +110,12 @@ def find_free_profile(profile):
         print("Found existing profiles for {}. Checking for active clusters".format(profile))
         # check if any are free. if not make a new one
         n_versions = num_profile_versions(profile)
-        for version in range(n_versions):
-            version_name = '{}_{}'.format(profile, version)
-            if not profile_running(version_name):
+        version_names = ['{}_{}'.format(profile, version) for version in range(n_versions)]
+        # probe every version concurrently
+        with ThreadPoolExecutor(max_workers=max(n_versions, 1)) as executor:
+            versions_running = list(executor.map(profile_running, version_names))
+        for version_name, version_running in zip(version_names, versions_running):
+            if not version_running:
                 print("Found free profile: {}".format(version_name))
                 return version_name
 
@@ -50,28 +127,77 @@ def find_free_profile(profile):
          # make version 0
 
 
-def profile_running(profile):
+def profile_running(profile, cluster_id='', timeout=1.):
     """ Checks if there is an ipyparallel cluster running with profile
 
+    Cheapest checks first: the controller's connection file must exist, the pid in its pid
+    file must be alive (if the controller runs on this host), and its registration port must
+    accept a TCP connection within timeout seconds.
+
     Args:
       profile: name of profile
+      cluster_id: (optional) id of the cluster within the profile
+      timeout: (optional) seconds to wait for the controller to accept a connection
 
     Returns:
       is_running: true if found
     """
-    # TODO: more sophisticated checks
-    # maybe we can just check to see if the connection files exist?
+    profile_dir = _profile_dir(profile)
+    file_prefix = 'ipcontroller-{}'.format(cluster_id) if cluster_id else 'ipcontroller'
+
+    connection_file_path = os.path.join(profile_dir, 'security', '{}-client.json'.format(file_prefix))
     try:
-        client = Client(profile=profile)
-        return True
-    except OSError as os_err:
-        print("Caught OSError while attempting to connect to {}: {}.".format(profile, os_err))
+        with open(connection_file_path) as connection_file:
+            connection_info = json.load(connection_file)
+    except (IOError, ValueError) as read_err:
+        print("No readable connection file for {}: {}".format(profile, read_err))
         return False
-    except TimeoutError as timeout_err:
-        print("Caught TimeoutError while attempting to connect to {}: {}".format(profile, timeout_err))
+
+    controller_host = connection_info.get('location') or socket.gethostname()
+    if controller_host == socket.gethostname():
+        pid_file_path = os.path.join(profile_dir, 'pid', '{}.pid'.format(file_prefix))
+        if os.path.exists(pid_file_path) and not _pid_file_alive(pid_file_path):
+            print("Controller for {} is not running, found stale pid file {}".format(profile, pid_file_path))
+            return False
+
+    interface = connection_info.get('interface', 'tcp://127.0.0.1').split('://')[-1]
+    if interface in ('*', '0.0.0.0', ''):
+        interface = controller_host
+    try:
+        with closing(socket.create_connection((interface, connection_info['registration']),
+                                              timeout=timeout)):
+            return True
+    except (OSError, KeyError) as connect_err:
+        print("Caught {} while attempting to connect to {}: {}".format(
+            type(connect_err).__name__, profile, connect_err))
         return False
 
 
+def _profile_dir(profile):
+    """ Returns the directory ipyparallel uses for profile
+    """
+    ipython_dir = os.environ.get('IPYTHONDIR', '~/.ipython')
+    return os.path.expanduser(os.path.join(ipython_dir, 'profile_{}'.format(profile)))
+
+
+def _pid_file_alive(pid_file_path):
+    """ Checks if the process in a pid file is alive
+    """
+    try:
+        with open(pid_file_path) as pid_file:
+            pid = int(pid_file.read().strip())
+    except (IOError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but belongs to someone else
+        return True
+    return True
+
+
 def profile_installed(profile):
     """ Checks if there is an entry for profile in ~/.ipython/
 
@@ -106,8 +232,8 @@ def install_profile(template_profile):
     Returns:
       full_profile: the full name of the installed profile
     """
-    # copy files from ipp-tools/profile/{template} to ~/.ipython
-    template_path = '{}/profiles/{}'.format(package_path(), template_profile)
+    # copy files from ipp_tools/profiles/{template} to ~/.ipython
+    template_path = os.path.join(package_path(), 'profiles', template_profile)
     dst_path = os.path.expanduser('~/.ipython/{}').format(template_profile)
     assert os.path.exists(template_path)
 
@@ -9,5 +9,6 @@ setup(name='ipp-tools',
       author='Andrew Berger',
       author_email='bergera@janelia.hhmi.org',
       url='https://github.com/TuragaLab/ipp-tools',
-      py_modules=['ipp_tools'],
+      packages=['ipp_tools'],
+      package_data={'ipp_tools': ['templates/*', 'profiles/*/*.py', 'profiles/*/startup/*']},
       install_requires=['ipyparallel'])
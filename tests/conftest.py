@@ -0,0 +1,41 @@
+""" Fixtures running tests against a local cluster of N_ENGINES engines
+
+Run with pytest from the repository root. Functions defined in test modules are sent to the
+engines by value, engines import ipp_tools from this checkout.
+"""
+
+import os
+
+import pytest
+
+N_ENGINES = 3
+PROFILE = 'ipp_tools_tests'
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def cluster():
+    ipyparallel = pytest.importorskip('ipyparallel')
+    # engines started during the session, e.g. replacements, inherit the path too
+    python_path = os.environ.get('PYTHONPATH')
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_PATH, python_path]))
+    # a profile of its own, so that code connecting by profile name finds this cluster
+    local_cluster = ipyparallel.Cluster(n=N_ENGINES, profile=PROFILE, cluster_id='')
+    local_cluster.start_cluster_sync()
+    yield local_cluster
+    local_cluster.stop_cluster_sync()
+    if python_path is None:
+        del os.environ['PYTHONPATH']
+    else:
+        os.environ['PYTHONPATH'] = python_path
+
+
+@pytest.fixture
+def client(cluster, request):
+    cloudpickle = pytest.importorskip('cloudpickle')
+    cloudpickle.register_pickle_by_value(request.module)
+    cluster_client = cluster.connect_client_sync()
+    cluster_client.wait_for_engines(N_ENGINES, timeout=60)
+    yield cluster_client
+    cluster_client.close()
+    cloudpickle.unregister_pickle_by_value(request.module)
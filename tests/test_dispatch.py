@@ -0,0 +1,250 @@
+""" Tests of windowed_map, on the local cluster of conftest
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+ipyparallel = pytest.importorskip('ipyparallel')
+
+from ipp_tools.dispatch import windowed_map
+
+from conftest import N_ENGINES
+
+
+def square(x):
+    return x * x
+
+
+def sleep_then_return(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def fail_first_attempt(marker_path):
+    """ Raises IOError the first time it's called with marker_path, returns the path after
+    """
+    if not os.path.exists(marker_path):
+        open(marker_path, 'w').close()
+        raise IOError("First attempt at {}".format(marker_path))
+    return marker_path
+
+
+def exit_on_first_attempt(marker_path):
+    """ Kills its engine the first time it's called with marker_path, returns the path after
+    """
+    if marker_path is not None and not os.path.exists(marker_path):
+        open(marker_path, 'w').close()
+        os._exit(1)
+    time.sleep(0.1)
+    return marker_path
+
+
+def straggle_on_first_attempt(marker_path):
+    """ Takes long the first time it's called with marker_path, returns quickly after
+    """
+    if marker_path is not None and not os.path.exists(marker_path):
+        open(marker_path, 'w').close()
+        time.sleep(20)
+    time.sleep(0.2)
+    return marker_path
+
+
+def hang_on_first_attempt(marker_path):
+    """ Ignores the timeout and interrupts the first time it's called with marker_path, like a
+    task stuck outside of Python, returns the path after
+    """
+    if marker_path is not None and not os.path.exists(marker_path):
+        open(marker_path, 'w').close()
+        import signal
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM, signal.SIGINT])
+        time.sleep(60)
+    time.sleep(0.1)
+    return marker_path
+
+
+def square_and_pid(x):
+    time.sleep(0.1)
+    return x * x, os.getpid()
+
+
+def allocate(n_mb):
+    return len(bytearray(n_mb * 2 ** 20))
+
+
+def array_stats(arrays):
+    return {name: array.sum() for name, array in arrays.items()}, arrays['ones'] * 2
+
+
+def test_results_in_order(client):
+    assert windowed_map(client, square, range(50), max_in_flight=4, use_cloudpickle=True) == \
+        [x * x for x in range(50)]
+
+
+def test_setup(client):
+    assert windowed_map(client, square, iter(range(20)), setup=lambda: None, use_cloudpickle=True) == \
+        [x * x for x in range(20)]
+
+
+def load_offset():
+    global OFFSET
+    OFFSET = 10
+
+
+def add_offset(x):
+    return x + OFFSET
+
+
+class CountSetups(object):
+    """ Callable setup, counts its calls on each engine
+    """
+
+    def __call__(self):
+        import builtins
+        builtins.n_setups = getattr(builtins, 'n_setups', 0) + 1
+
+
+def test_setup_globals_are_visible_to_fnc(client):
+    assert windowed_map(client, add_offset, range(10), setup=load_offset, use_cloudpickle=True) == \
+        [x + 10 for x in range(10)]
+
+
+def test_callable_setup(client):
+    client[:].execute('import builtins; builtins.n_setups = 0', block=True)
+    assert windowed_map(client, square, range(10), setup=CountSetups(), use_cloudpickle=True) == \
+        [x * x for x in range(10)]
+    # once per engine, however many tasks it ran
+    assert client[:].apply_sync(lambda: __import__('builtins').n_setups) == [1] * N_ENGINES
+
+
+def test_timeout(client):
+    with pytest.warns(UserWarning, match='1 tasks failed'):
+        results = windowed_map(client, sleep_then_return, [0.1, 10, 0.1], use_cloudpickle=True,
+                               task_timeout=1, timeout_retries=1, status_interval=0.2)
+    assert results[0] == results[2] == 0.1
+    assert isinstance(results[1], ipyparallel.RemoteError)
+    assert results[1].ename == 'TaskTimeout'
+
+
+def test_retry_on_error(client, tmp_path):
+    marker_paths = [str(tmp_path / str(idx)) for idx in range(5)]
+    retry_policy = {'retry_on': (IOError,), 'backoff_seconds': 0.1}
+    assert windowed_map(client, fail_first_attempt, marker_paths, use_cloudpickle=True,
+                        retry_policy=retry_policy) == marker_paths
+
+
+def test_error_is_raised_without_retries(client, tmp_path):
+    with pytest.raises(ipyparallel.RemoteError):
+        windowed_map(client, fail_first_attempt, [str(tmp_path / 'marker')], use_cloudpickle=True,
+                     retry_policy={'max_attempts': 1})
+
+
+def test_speculation(client, tmp_path):
+    marker_paths = [None] * 10 + [str(tmp_path / 'straggler')]
+    start_time = time.time()
+    results = windowed_map(client, straggle_on_first_attempt, marker_paths, use_cloudpickle=True,
+                           speculative_factor=3, speculative_budget=0.5, status_interval=0.2)
+    assert results == marker_paths
+    assert time.time() - start_time < 15
+    # the losing copy was interrupted, its engine is free
+    start_time = time.time()
+    client[:].apply_sync(square, 2)
+    assert time.time() - start_time < 5
+
+
+def test_memory_limit(client):
+    with pytest.warns(UserWarning, match='1 tasks failed'):
+        results = windowed_map(client, allocate, [1, 1024, 1], use_cloudpickle=True, task_memory_mb=512)
+    assert results[0] == results[2] == 2 ** 20
+    assert isinstance(results[1], ipyparallel.RemoteError)
+    assert results[1].ename == 'MemoryError'
+    # engines are usable once their task hit the limit
+    assert windowed_map(client, allocate, [768] * N_ENGINES, use_cloudpickle=True) == [768 * 2 ** 20] * N_ENGINES
+
+
+def load_ballast():
+    global BALLAST
+    BALLAST = bytearray(400 * 2 ** 20)
+
+
+def test_memory_limit_excludes_engine_memory(client):
+    # engines start tasks with more memory mapped than the limit of each task
+    try:
+        assert windowed_map(client, allocate, [64] * 6, setup=load_ballast, use_cloudpickle=True,
+                            task_memory_mb=256) == [64 * 2 ** 20] * 6
+    finally:
+        client[:].execute('BALLAST = None', block=True)
+
+
+def test_oob_serialization(client):
+    np = pytest.importorskip('numpy')
+    from ipp_tools.serialization import oob_args, oob_results
+    arrays = [{'ones': np.ones(2 ** 16) * idx, 'range': np.arange(idx)} for idx in range(6)]
+    results = windowed_map(client, oob_results(array_stats, compress='zlib'), oob_args(arrays, compress='zlib'),
+                           use_cloudpickle=True)
+    for idx, (sums, doubled) in enumerate(results):
+        assert sums == {'ones': 2 ** 16 * idx, 'range': sum(range(idx))}
+        assert np.array_equal(doubled, np.ones(2 ** 16) * idx * 2)
+
+
+def test_engine_loss(cluster, client, tmp_path):
+    lost_engines = []
+    marker_paths = [None] * 10 + [str(tmp_path / 'lost')] + [None] * 10
+    results = windowed_map(client, exit_on_first_attempt, marker_paths, use_cloudpickle=True,
+                           engine_lost_callback=lost_engines.append)
+    assert results == marker_paths
+    assert len(lost_engines) == 1
+    # replace the lost engine for the tests that run after this one
+    cluster.start_engines_sync(n=1)
+
+
+def test_stuck_engine_is_shut_down(cluster, client, tmp_path, monkeypatch):
+    monkeypatch.setattr('ipp_tools.dispatch.TIMEOUT_GRACE_SECONDS', 1)
+    lost_engines = []
+    marker_paths = [None] * 3 + [str(tmp_path / 'stuck')] + [None] * 3
+    start = time.time()
+    results = windowed_map(client, hang_on_first_attempt, marker_paths, use_cloudpickle=True,
+                           task_timeout=2, status_interval=0.5, engine_lost_callback=lost_engines.append)
+    assert results == marker_paths
+    assert len(lost_engines) == 1
+    assert time.time() - start < 60
+    cluster.start_engines_sync(n=1)
+
+
+def test_recycling(cluster, client):
+    # stands in for the loops of slurm_map restarting recycled engines
+    stop = threading.Event()
+
+    def replace_recycled_engines():
+        while not stop.wait(0.5):
+            n_missing = N_ENGINES - len(client.ids)
+            if n_missing > 0:
+                cluster.start_engines_sync(n=n_missing)
+
+    replacer = threading.Thread(target=replace_recycled_engines)
+    replacer.start()
+    try:
+        results = windowed_map(client, square_and_pid, range(24), use_cloudpickle=True,
+                               max_tasks_per_engine=3, status_interval=0.5)
+    finally:
+        stop.set()
+        replacer.join()
+    assert [result for result, _ in results] == [x * x for x in range(24)]
+    pids = [pid for _, pid in results]
+    assert max(pids.count(pid) for pid in set(pids)) <= 3
+    assert len(set(pids)) >= 24 // 3
+    client.wait_for_engines(N_ENGINES, timeout=60)
+
+
+def test_no_engines_times_out():
+    empty_cluster = ipyparallel.Cluster(n=0)
+    empty_cluster.start_controller_sync()
+    try:
+        empty_client = empty_cluster.connect_client_sync()
+        with pytest.raises(TimeoutError):
+            windowed_map(empty_client, square, range(3), engine_wait_timeout=2)
+        empty_client.close()
+    finally:
+        empty_cluster.stop_cluster_sync()
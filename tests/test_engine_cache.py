@@ -0,0 +1,66 @@
+import pytest
+
+from ipp_tools import engine_cache
+from ipp_tools.dispatch import windowed_map
+
+
+@pytest.fixture
+def cache():
+    max_mb = engine_cache._CONFIG['max_bytes'] / 2. ** 20
+    engine_cache.clear()
+    engine_cache._STATS.update(hits=0, misses=0, evictions=0)
+    yield engine_cache
+    engine_cache.clear()
+    engine_cache.configure(max_mb)
+
+
+def test_hit_and_miss(cache):
+    loads = []
+    for _ in range(3):
+        assert cache.get('a', lambda: loads.append('a') or 'A', n_bytes=10) == 'A'
+    assert loads == ['a']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['n_objects'], stats['n_bytes']) == (2, 1, 1, 10)
+
+
+def test_evicts_least_recently_used(cache):
+    cache.configure(3 / 2. ** 20)  # 3 bytes
+    for key in 'abc':
+        cache.get(key, lambda: key, n_bytes=1)
+    cache.get('a', lambda: 'reloaded', n_bytes=1)  # a is now the most recently used
+    cache.get('d', lambda: 'd', n_bytes=1)
+    assert list(cache._CACHE) == ['c', 'a', 'd']
+    assert cache.stats()['evictions'] == 1
+
+    cache.configure(1 / 2. ** 20)
+    assert list(cache._CACHE) == ['d']
+    assert cache.stats()['n_bytes'] == 1
+
+
+def test_oversized_objects_are_not_cached(cache):
+    cache.configure(1 / 2. ** 20)
+    cache.get('small', lambda: 's', n_bytes=1)
+    assert cache.get('big', lambda: 'b', n_bytes=2) == 'b'
+    assert list(cache._CACHE) == ['small']
+
+
+def test_sizeof_counts_arrays_and_containers():
+    np = pytest.importorskip('numpy')
+    array = np.zeros(1000)
+    assert engine_cache._sizeof(array) == array.nbytes
+    assert engine_cache._sizeof({'x': [array, array]}) > 2 * array.nbytes
+
+
+def cached_task(x):
+    from ipp_tools import engine_cache
+    return engine_cache.get(x % 2, lambda: x % 2, n_bytes=1)
+
+
+def test_report_stats(client, capsys):
+    client[:].execute('from ipp_tools import engine_cache; engine_cache.clear()', block=True)
+    assert windowed_map(client, cached_task, range(12), use_cloudpickle=True) == [x % 2 for x in range(12)]
+
+    engine_stats = engine_cache.report_stats(client)
+    assert sorted(engine_stats) == sorted(client.ids)
+    assert sum(stats['hits'] + stats['misses'] for stats in engine_stats.values()) >= 12
+    assert 'Engine cache:' in capsys.readouterr().out
@@ -0,0 +1,78 @@
+""" Tests of the GPU utils, on hosts without GPUs
+"""
+
+import math
+import time
+
+import numpy as np
+
+from ipp_tools.gpu import (GPU_SNAPSHOT_DTYPE, _parse_gpu_query, cluster_gpu_snapshot, device_gpu_id, free_gpus,
+                           gpu_is_free, start_gpu_sampler, summarize_gpu_samples)
+
+GPU_QUERY_OUTPUT = """0, GPU-aaaa, 2291, 12189, 100
+1, GPU-bbbb, 3, 16160, 0
+2, GPU-cccc, [N/A], 81920, [N/A]
+"""
+GPU_PROCESS_QUERY_OUTPUT = """GPU-aaaa, 89398
+GPU-aaaa, 89399
+GPU-cccc, 1234
+"""
+
+
+def test_parse_gpu_query():
+    gpus = _parse_gpu_query(GPU_QUERY_OUTPUT, GPU_PROCESS_QUERY_OUTPUT)
+    assert [gpu['id'] for gpu in gpus] == [0, 1, 2]
+    assert gpus[0] == {'id': 0, 'memory_used': 2291., 'memory_total': 12189., 'usage_frac': 1.,
+                       'n_processes': 2}
+    assert gpus[1]['n_processes'] == 0
+    assert math.isnan(gpus[2]['memory_used']) and math.isnan(gpus[2]['usage_frac'])
+
+
+def test_free_gpus():
+    snapshot = np.array([
+        ('host1', 0, 2291., 12189., 1., 1),
+        ('host1', 1, 3., 16160., 0., 0),
+        ('host2', 0, 100., 12189., 0.5, 1),
+        ('host2', 1, float('nan'), 12189., float('nan'), 0),
+    ], dtype=GPU_SNAPSHOT_DTYPE)
+    free = free_gpus(snapshot)
+    assert list(zip(free['host'], free['gpu_id'])) == [('host1', 1)]
+    assert len(free_gpus(snapshot, max_usage=0.6)) == 2
+
+
+def test_cluster_gpu_snapshot_skips_hosts_without_gpus(client, capsys):
+    snapshot = cluster_gpu_snapshot(client)
+    assert snapshot.dtype == np.dtype(GPU_SNAPSHOT_DTYPE)
+    assert len(snapshot) == 0
+    assert 'Failed to query the GPUs' in capsys.readouterr().out
+
+
+def test_device_gpu_id():
+    assert device_gpu_id('/gpu:1') == 1
+    assert device_gpu_id('/GPU:0') == 0
+    assert device_gpu_id('/cpu:0') is None
+
+
+def test_gpu_is_free_ignores_own_memory():
+    gpu_status = {'id': 0, 'memory_frac': 0.5, 'usage_frac': 0.,
+                  'processes': [{'pid': 123, 'mem_frac': 0.45}, {'pid': 456, 'mem_frac': 0.05}]}
+    assert not gpu_is_free(gpu_status)
+    assert gpu_is_free(gpu_status, ignore_pids=[123])
+    assert not gpu_is_free(dict(gpu_status, usage_frac=0.5), ignore_pids=[123])
+
+
+def test_summarize_gpu_samples():
+    assert summarize_gpu_samples([]) is None
+    # 10 seconds fully used, then 30 seconds idle
+    samples = [(100., 1., 2000), (110., 0., 500)]
+    summary = summarize_gpu_samples(samples, end_time=140.)
+    assert summary == {'n_samples': 2, 'mean_usage': 0.25, 'peak_usage': 1., 'peak_memory': 2000,
+                       'idle_gpu_seconds': 30.}
+
+
+def test_gpu_sampler_without_gpus():
+    stop = start_gpu_sampler(0, interval=0.05)
+    time.sleep(0.2)
+    start_time = time.time()
+    assert stop() == []
+    assert time.time() - start_time < 1
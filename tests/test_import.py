@@ -0,0 +1,41 @@
+""" Tests that importing ipp_tools stays light, and of the profile shipped with the package
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import ipp_tools
+from ipp_tools.utils import install_profile, package_path, profile_installed
+
+from conftest import REPO_PATH
+
+MODULES = ['ipp_tools', 'ipp_tools.engine_pool', 'ipp_tools.gpu', 'ipp_tools.log_tools', 'ipp_tools.mappers',
+           'ipp_tools.pilot', 'ipp_tools.pool', 'ipp_tools.slurm', 'ipp_tools.startup', 'ipp_tools.utils']
+HEAVY_MODULES = ['ipyparallel', 'numpy', 'zmq', 'IPython']
+
+
+def test_import_is_light():
+    script = 'import json, sys\nfor module in {!r}: __import__(module)\nprint(json.dumps(sorted(sys.modules)))'.format(
+        MODULES)
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=REPO_PATH, universal_newlines=True)
+    imported = json.loads(output)
+    assert [module for module in HEAVY_MODULES if module in imported] == []
+
+
+def test_local_map_is_reexported():
+    from ipp_tools.engine_pool import local_map
+    assert ipp_tools.local_map is local_map
+
+
+def test_install_profile(tmp_path, monkeypatch):
+    profile_files = os.listdir(os.path.join(package_path(), 'profiles', 'profile_slurm'))
+    assert 'ipcluster_config.py' in profile_files
+    assert not [profile_file for profile_file in profile_files if profile_file.endswith('~')]
+
+    monkeypatch.setenv('HOME', str(tmp_path))
+    assert not profile_installed('profile_slurm')
+    install_profile('profile_slurm')
+    assert profile_installed('profile_slurm')
+    assert (tmp_path / '.ipython' / 'profile_slurm' / 'ipcluster_config.py').exists()
@@ -0,0 +1,82 @@
+""" Tests of queued logging and engine log forwarding, the latter on the local cluster of conftest
+"""
+
+import logging
+import socket
+import struct
+import time
+
+from ipp_tools.log_tools import setup_logging, forward_engine_logs, _MAC_LEN
+
+
+def log_from_engine(message):
+    logging.getLogger('task').info(message)
+
+
+def sleep_on_engine(seconds):
+    time.sleep(seconds)
+
+
+def read_log(log_dir, log_name, expected_lines, timeout=5.):
+    """ Returns the lines of a log once it has expected_lines, or after timeout seconds
+    """
+    deadline = time.time() + timeout
+    while True:
+        log_file = log_dir / log_name
+        lines = log_file.read_text().splitlines() if log_file.exists() else []
+        if len(lines) >= expected_lines or time.time() > deadline:
+            return lines
+        time.sleep(0.1)
+
+
+def test_setup_logging_is_idempotent(tmp_path):
+    logger = setup_logging('idempotent.log', str(tmp_path))
+    assert setup_logging('idempotent.log', str(tmp_path)) is logger
+    assert len(logger.handlers) == 1
+    logger.info('once')
+    assert len(read_log(tmp_path, 'idempotent.log', 1)) == 1
+
+
+def test_setup_logging_orders_by_creation_time(tmp_path):
+    logger = setup_logging('ordered.log', str(tmp_path), reorder_window=0.5)
+    now = time.time()
+    for message, created in [('second', now), ('first', now - 0.2)]:
+        logger.handle(logging.makeLogRecord({'name': logger.name, 'levelno': logging.INFO, 'levelname': 'INFO',
+                                             'msg': message, 'created': created}))
+    lines = read_log(tmp_path, 'ordered.log', 2)
+    assert [line.rsplit(' - ', 1)[1] for line in lines] == ['first', 'second']
+
+
+def test_forward_engine_logs(client, tmp_path):
+    logger = setup_logging('engines.log', str(tmp_path))
+    forwarding = forward_engine_logs(client, logger)
+    try:
+        client[:].apply_sync(log_from_engine, 'hello from an engine')
+        lines = read_log(tmp_path, 'engines.log', 1 + len(client.ids))
+    finally:
+        forwarding.stop()
+    assert sum('hello from an engine' in line for line in lines) == len(client.ids)
+
+
+def test_forward_engine_logs_drops_unsigned_records(client, tmp_path):
+    logger = setup_logging('unsigned.log', str(tmp_path))
+    forwarding = forward_engine_logs(client, logger, engine_ids=[])
+    try:
+        payload = b'{"msg": "forged"}'
+        with socket.create_connection(('127.0.0.1', forwarding.port)) as connection:
+            connection.sendall(struct.pack('>L', len(payload)) + b'\0' * _MAC_LEN + payload)
+        time.sleep(2)
+    finally:
+        forwarding.stop()
+    assert not any('forged' in line for line in read_log(tmp_path, 'unsigned.log', 0, timeout=0))
+
+
+def test_stop_does_not_wait_for_running_tasks(client, tmp_path):
+    logger = setup_logging('busy.log', str(tmp_path))
+    forwarding = forward_engine_logs(client, logger)
+    running = client[:].apply_async(sleep_on_engine, 5)
+    time.sleep(0.5)
+    start_time = time.time()
+    forwarding.stop()
+    assert time.time() - start_time < 2
+    running.get()
@@ -0,0 +1,79 @@
+""" Tests of gpu_job_runner on the local cluster of conftest, which has no GPUs
+"""
+
+import os
+import time
+
+import pytest
+
+from ipp_tools import mappers
+from ipp_tools.mappers import gpu_job_runner, _wait_for_device
+
+from conftest import PROFILE
+
+
+def double(job_arg, device=None):
+    return 2 * job_arg, device
+
+
+@pytest.mark.parametrize('devices_assigned', [False, True])
+def test_gpu_job_runner(client, tmp_path, devices_assigned):
+    client[:].use_cloudpickle()
+    if devices_assigned:
+        client[:].push({'device': '/gpu:0'}, block=True)
+    finished_jobs = []
+    # engines can't read the status of their device, so they admit jobs without waiting
+    job_records = gpu_job_runner(double, [1, 2, 3], ipp_profile=PROFILE, log_dir=str(tmp_path),
+                                 devices_assigned=devices_assigned, job_callback=finished_jobs.append,
+                                 telemetry_interval=0.1)
+
+    assert len(finished_jobs) == 3
+    for job_idx, job_record in enumerate(job_records):
+        result, telemetry, run_time = job_record['async_result'].get()
+        assert result[0] == 2 * (job_idx + 1)
+        assert result[1].startswith('/gpu:')
+        assert telemetry is None
+        assert job_record['run_time'] == run_time
+        assert job_record['engine_id'] in client.ids
+    # the log is written in the background
+    log_file = tmp_path / 'job_runner'
+    deadline = time.time() + 5
+    while not (log_file.exists() and 'All jobs finished' in log_file.read_text()) and time.time() < deadline:
+        time.sleep(0.1)
+    assert 'All jobs finished' in log_file.read_text()
+    assert os.path.exists(str(tmp_path / 'job_runner_gpu_telemetry.csv'))
+
+
+def test_gpu_job_runner_assigns_one_device_per_engine(client, tmp_path):
+    client[:].use_cloudpickle()
+    gpu_job_runner(double, [1], ipp_profile=PROFILE, log_dir=str(tmp_path), telemetry_interval=None)
+    # every engine of the cluster runs on this host
+    assert sorted(client[:].pull('device', block=True)) == ['/gpu:{}'.format(idx) for idx in range(len(client.ids))]
+    # job_fnc is broadcast with the devices, jobs refer to it by name
+    assert all(remote_fnc(3) == (6, None) for remote_fnc in client[:].pull('job_fnc', block=True))
+
+
+def gpu_status(memory_frac, usage_frac, processes=()):
+    return {'id': 0, 'memory_frac': memory_frac, 'usage_frac': usage_frac, 'processes': list(processes)}
+
+
+def test_wait_for_device_admits_without_gpu_status():
+    # nvidia-smi isn't available here
+    with pytest.warns(UserWarning, match='Failed to read the status'):
+        _wait_for_device('/gpu:0', 0.1, 0.2, admission_patience=60)
+
+
+def test_wait_for_device_admits_unknown_devices(monkeypatch):
+    monkeypatch.setattr(mappers, 'fetch_gpu_status', lambda: [])
+    with pytest.warns(UserWarning, match='not found'):
+        _wait_for_device('/gpu:0', 0.1, 0.2, admission_patience=60)
+
+
+def test_wait_for_device_backs_off_busy_devices(monkeypatch):
+    from ipyparallel.error import UnmetDependency
+
+    monkeypatch.setattr(mappers, 'fetch_gpu_status', lambda: [gpu_status(0.5, 0.9)])
+    with pytest.raises(UnmetDependency):
+        _wait_for_device('/gpu:0', 0.1, 0.2, admission_patience=0.2)
+    monkeypatch.setattr(mappers, 'fetch_gpu_status', lambda: [gpu_status(0.05, 0.)])
+    _wait_for_device('/gpu:0', 0.1, 0.2, admission_patience=0.2)
@@ -0,0 +1,61 @@
+""" Tests of pilot runs and of sizing from their statistics
+"""
+
+from ipp_tools.pilot import pilot_run, recommend_resources, choose_backend, ENGINE_BASE_MB, MEMORY_STEP_MB
+from ipp_tools.slurm import process_resource_spec, slurm_map
+
+
+def allocate(n_mb):
+    return len(bytearray(n_mb * 2 ** 20))
+
+
+def test_pilot_run_measures_tasks():
+    # the driver's memory doesn't count against the tasks
+    ballast = bytearray(256 * 2 ** 20)
+    results, stats = pilot_run(allocate, [16, 128], n_processes=2)
+    assert results == [16 * 2 ** 20, 128 * 2 ** 20]
+    assert len(stats['run_seconds']) == len(stats['setup_seconds']) == 2
+    assert stats['task_rss_mb'][0] < 100 < stats['task_rss_mb'][1] < 200
+    del ballast
+
+
+def test_pilot_run_accepts_closures():
+    offset = 3
+    loaded = []
+    results, _ = pilot_run(lambda x: x + offset + len(loaded), [1, 2], setup=lambda: loaded.append(1))
+    assert results == [5, 6]
+
+
+def test_recommend_resources():
+    stats = {'run_seconds': [2., 4.], 'setup_seconds': [0., 0.], 'task_rss_mb': [100., 1000.]}
+    resource_spec = process_resource_spec({'max_workers': 100, 'min_workers': 10})
+    spec, chunksize = recommend_resources(stats, 3600, 600, resource_spec)
+    # 3600 tasks of 3 seconds in 600 seconds
+    assert spec['max_workers'] == 18
+    assert spec['min_workers'] == 10
+    assert spec['worker_mem_mb'] % MEMORY_STEP_MB == 0
+    assert spec['worker_mem_mb'] >= ENGINE_BASE_MB + 1000
+    assert chunksize == 1
+
+
+def test_recommend_resources_chunks_short_tasks():
+    stats = {'run_seconds': [0.01] * 4, 'setup_seconds': [0.] * 4, 'task_rss_mb': [1.] * 4}
+    spec, chunksize = recommend_resources(stats, 100000, 60, process_resource_spec({}))
+    assert spec['max_workers'] == 17
+    assert chunksize == 100
+
+
+def test_choose_backend():
+    stats = {'run_seconds': [0.01] * 4, 'setup_seconds': [0.] * 4, 'task_rss_mb': [1.] * 4}
+    assert choose_backend(stats, 10, process_resource_spec({}), startup_seconds=60)[0] == 'local'
+    slow_stats = {'run_seconds': [60.] * 4, 'setup_seconds': [0.] * 4, 'task_rss_mb': [1.] * 4}
+    assert choose_backend(slow_stats, 1000, process_resource_spec({'max_workers': 100}),
+                          startup_seconds=60)[0] == 'slurm'
+
+
+def test_slurm_map_without_tasks():
+    assert slurm_map(allocate, [], {}, pilot='recommend') == []
+
+
+def test_slurm_map_pilot_finishes_small_maps():
+    assert slurm_map(lambda x: 2 * x, [1, 2, 3], {}, pilot='recommend', n_pilot_tasks=8) == [2, 4, 6]
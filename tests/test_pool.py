@@ -0,0 +1,55 @@
+""" Tests of the local process pool backend
+"""
+
+import time
+
+import pytest
+
+from ipp_tools.dispatch import TaskTimeout
+from ipp_tools.pool import pool_map
+from ipp_tools.slurm import slurm_map
+
+
+def square(x):
+    return x * x
+
+
+def sleep_then_return(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError("three")
+    return x
+
+
+def test_pool_map_keeps_order():
+    assert pool_map(square, iter(range(100)), n_processes=2, chunksize=7, max_in_flight=3) == \
+        [x * x for x in range(100)]
+
+
+def test_pool_map_timeout():
+    with pytest.warns(UserWarning, match='1 chunks timed out'):
+        results = pool_map(sleep_then_return, [0.1, 10, 0.1], n_processes=2, task_timeout=1)
+    assert results[0] == results[2] == 0.1
+    assert isinstance(results[1], TaskTimeout)
+
+
+def test_pool_map_raises_task_errors():
+    with pytest.raises(ValueError):
+        pool_map(fail_on_three, range(5), n_processes=2)
+
+
+def test_pool_map_replaces_processes():
+    assert pool_map(square, range(20), n_processes=2, max_tasks_per_process=1) == [x * x for x in range(20)]
+
+
+def test_slurm_map_local_backend():
+    assert slurm_map(square, range(10), {}, backend='local', chunksize=3) == [x * x for x in range(10)]
+
+
+def test_slurm_map_auto_backend_runs_short_maps_locally():
+    assert slurm_map(square, range(50), {'max_workers': 10}, backend='auto', n_pilot_tasks=4) == \
+        [x * x for x in range(50)]
@@ -0,0 +1,59 @@
+""" Tests of out-of-band serialization of task arguments and results
+"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+serialize = pytest.importorskip('ipyparallel.serialize')
+
+from ipp_tools.serialization import OOBPayload, _maybe_compress, compress, decompress, register_canning
+
+
+def roundtrip(obj):
+    """ Serializes obj as ipyparallel sends it, returns what the other side gets and the number of frames
+    """
+    frames = serialize.serialize_object(obj)
+    return serialize.deserialize_object(frames)[0], len(frames)
+
+
+def test_nested_arrays_are_sent_out_of_band():
+    register_canning()
+    arrays = {'images': [np.arange(2 ** 16, dtype='f4'), np.ones((64, 64))], 'label': 'nested'}
+    received, n_frames = roundtrip(OOBPayload(arrays))
+    # one frame for the pickle, one per array
+    assert n_frames == 3
+    assert received['label'] == 'nested'
+    for sent_array, received_array in zip(arrays['images'], received['images']):
+        assert np.array_equal(sent_array, received_array)
+        assert received_array.dtype == sent_array.dtype
+
+
+def test_non_contiguous_arrays_are_sent_in_band():
+    register_canning()
+    array = np.arange(100).reshape(10, 10)[:, ::2]
+    received, n_frames = roundtrip(OOBPayload(array))
+    assert n_frames == 1
+    assert np.array_equal(received, array)
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'bz2', 'lzma'])
+def test_compressed_roundtrip(codec):
+    register_canning()
+    arrays = [np.zeros(2 ** 16), np.random.RandomState(0).rand(2 ** 14), np.zeros(10)]
+    frames = serialize.serialize_object(OOBPayload(arrays, compress=codec, compress_threshold=2 ** 10))
+    # the zeros compress, random data and buffers below the threshold are sent as they are
+    assert sum(len(frame) for frame in frames) < arrays[0].nbytes
+    received = serialize.deserialize_object(frames)[0]
+    for sent_array, received_array in zip(arrays, received):
+        assert np.array_equal(sent_array, received_array)
+
+
+def test_incompressible_data_is_sent_uncompressed():
+    data = np.random.RandomState(0).bytes(2 ** 16)
+    assert _maybe_compress(data, 'zlib') == (data, None)
+    assert decompress(compress(b'abc' * 1000, 'zlib'), 'zlib') == b'abc' * 1000
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        OOBPayload(np.zeros(10), compress='zip')
@@ -0,0 +1,47 @@
+import subprocess
+import time
+
+from ipp_tools import slurm
+from ipp_tools.dispatch import RECYCLE_EXIT_CODE
+
+
+def write_script(path, body):
+    path.write_text('#!/bin/bash\n' + body)
+    path.chmod(0o755)
+    return str(path)
+
+
+def wait_for_exit(process, timeout=10):
+    deadline = time.time() + timeout
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    return process.poll()
+
+
+def test_local_engine_restarts_when_recycled(tmp_path):
+    # python can't import ipp_tools, so the fake ipengine runs as a plain engine
+    write_script(tmp_path / 'python', 'exit 1\n')
+    runs = tmp_path / 'runs'
+    engine_path = write_script(tmp_path / 'ipengine', 'echo "$@" >> {}\n[ $(wc -l < {}) -lt 3 ] && exit {}\nexit 0\n'.format(
+        runs, runs, RECYCLE_EXIT_CODE))
+
+    local_engine = slurm._start_local_engine(engine_path, 'test-cluster', n_threads=1)
+    assert wait_for_exit(local_engine) == 0
+    assert runs.read_text().splitlines() == ['--profile={} --cluster-id=test-cluster'.format(slurm.PROFILE_NAME)] * 3
+
+
+def test_shut_down_cluster_kills_local_engines(tmp_path):
+    class FailingLogForwarding(object):
+        def stop(self):
+            raise RuntimeError('engines are gone')
+
+    controller = subprocess.Popen(['sleep', '60'], start_new_session=True)
+    write_script(tmp_path / 'python', 'exit 1\n')
+    engine_path = write_script(tmp_path / 'ipengine', 'sleep 60\n')
+    local_engines = [slurm._start_local_engine(engine_path, 'test-cluster', n_threads=1) for _ in range(2)]
+
+    slurm._shut_down_cluster(controller, None, local_engines, FailingLogForwarding(), 'test-job', None)
+    for process in [controller] + local_engines:
+        assert wait_for_exit(process) is not None
+    # the engines themselves, not only the loops restarting them
+    assert subprocess.call(['pgrep', '-f', engine_path], stdout=subprocess.DEVNULL) == 1
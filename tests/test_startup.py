@@ -0,0 +1,83 @@
+""" Tests of engine startup timing and of the scripts launching engines
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from ipp_tools import startup
+from ipp_tools.slurm import RECYCLE_EXIT_CODE
+from ipp_tools.utils import package_path
+
+from conftest import PROFILE, REPO_PATH
+
+
+def test_phase_helpers():
+    assert startup._percentile([1, 2, 3, 4, 5], 50) == 3
+    assert startup._percentile([1, 2, 3, 4, 5], 95) == 5
+    times = {'launch': 10., 'registered': 12.5, 'process_start': 10.01}
+    assert startup._seconds_between(times, 'launch', 'registered') == 2.5
+    assert startup._seconds_between(times, 'launch', 'imported') is None
+    # process start times are rounded to a clock tick
+    assert startup._seconds_between({'launch': 10.02, 'process_start': 10.01}, 'launch', 'process_start') == 0.
+
+
+def test_engine_startup(monkeypatch):
+    monkeypatch.setenv(startup.LAUNCH_TIME_VAR, str(time.time() - 5))
+    monkeypatch.delenv(startup.STAGE_START_VAR, raising=False)
+    monkeypatch.setitem(startup._TIMES, 'registered', time.time())
+    engine_startup = startup.engine_startup()
+    assert 4 < engine_startup['startup_seconds'] < 6
+    assert engine_startup['staging'] is None
+    assert engine_startup['environment'] is not None
+
+
+def test_launched_engine_reports_its_startup(client):
+    engine_ids = set(client.ids)
+    env = dict(os.environ, **{startup.LAUNCH_TIME_VAR: str(time.time())})
+    engine = subprocess.Popen([sys.executable, '-m', 'ipp_tools.launch_engine', '--profile={}'.format(PROFILE),
+                               '--IPEngine.startup_command={}'.format(startup.STARTUP_COMMAND)], env=env)
+    try:
+        client.wait_for_engines(len(engine_ids) + 1, timeout=60)
+        engine_id, = set(client.ids) - engine_ids
+        # startup_command runs once the engine is registered
+        time.sleep(1)
+        engine_startups = startup.report_startup(client)
+        for phase in ['environment', 'imports', 'connection_file', 'registration', 'startup_seconds']:
+            assert engine_startups[engine_id][phase] is not None
+        assert engine_startups[engine_id]['staging'] is None
+        client.shutdown(targets=[engine_id], block=True)
+        engine.wait(timeout=30)
+    finally:
+        if engine.poll() is None:
+            engine.kill()
+
+
+@pytest.mark.parametrize('has_ipp_tools', [True, False])
+def test_sbatch_script_engine_command(tmp_path, has_ipp_tools):
+    with open(os.path.join(package_path(), 'templates', 'slurm_template.sh')) as template_file:
+        template = template_file.read()
+    script = template.format(
+        job_name='job', output_path='out', n_tasks=1, mem_mb=1000, n_cpus=1, n_gpus=0, engine_bin='bin',
+        profile='profile', controller_hostname='host', cluster_id='cluster', comment='job',
+        recycle_exit_code=RECYCLE_EXIT_CODE, thread_exports='', srun_options='', stage_env='',
+        startup_command=startup.STARTUP_COMMAND)
+    engine_bin = tmp_path / 'bin'
+    engine_bin.mkdir()
+    # a python that runs the tests' interpreter, without ipp_tools on its path if not has_ipp_tools
+    python_path = REPO_PATH if has_ipp_tools else str(tmp_path)
+    (engine_bin / 'python').write_text('#!/bin/bash\nPYTHONPATH={} exec {} "$@"\n'.format(python_path, sys.executable))
+    (engine_bin / 'python').chmod(0o755)
+    script = script.replace('ENGINE_BIN=~/anaconda3/bin', 'ENGINE_BIN={}'.format(engine_bin))
+    # print the engine command instead of running it
+    script = script.replace('srun ', 'echo ')
+    output = subprocess.check_output(['bash', '-c', script], cwd=str(tmp_path), universal_newlines=True)
+    engine_command = output.splitlines()[-1]
+    if has_ipp_tools:
+        assert engine_command.startswith('{}/python -m ipp_tools.launch_engine'.format(engine_bin))
+        assert 'startup_command={}'.format(startup.STARTUP_COMMAND) in engine_command
+    else:
+        assert engine_command.startswith('{}/ipengine --profile=profile'.format(engine_bin))
@@ -0,0 +1,56 @@
+""" Tests of the misc. utils
+"""
+
+import json
+import socket
+import subprocess
+import sys
+
+from ipp_tools.utils import profile_running
+
+from conftest import PROFILE
+
+
+def write_profile(ipython_dir, location, port, pid=None):
+    """ Writes the files of a controller of profile 'fake' to ipython_dir
+    """
+    profile_dir = ipython_dir / 'profile_fake'
+    (profile_dir / 'security').mkdir(parents=True)
+    (profile_dir / 'pid').mkdir()
+    connection_info = {'location': location, 'interface': 'tcp://127.0.0.1', 'registration': port}
+    (profile_dir / 'security' / 'ipcontroller-client.json').write_text(json.dumps(connection_info))
+    if pid is not None:
+        (profile_dir / 'pid' / 'ipcontroller.pid').write_text(str(pid))
+
+
+def closed_port():
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+def test_profile_running(cluster):
+    assert profile_running(PROFILE)
+
+
+def test_profile_without_connection_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('IPYTHONDIR', str(tmp_path))
+    assert not profile_running('fake')
+
+
+def test_profile_with_stale_pid_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('IPYTHONDIR', str(tmp_path))
+    dead_process = subprocess.Popen([sys.executable, '-c', ''])
+    dead_process.wait()
+    with socket.socket() as listening_socket:
+        # the port accepts connections, but the controller that wrote the pid file is gone
+        listening_socket.bind(('127.0.0.1', 0))
+        listening_socket.listen(1)
+        write_profile(tmp_path, socket.gethostname(), listening_socket.getsockname()[1], dead_process.pid)
+        assert not profile_running('fake')
+
+
+def test_profile_with_closed_port(tmp_path, monkeypatch):
+    monkeypatch.setenv('IPYTHONDIR', str(tmp_path))
+    write_profile(tmp_path, 'another-host', closed_port())
+    assert not profile_running('fake')